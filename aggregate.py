@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Count places or submissions by one or more of their attributes, e.g. ideas per
+district per day, or support per category.
+
+The records are loaded into columns, one per attribute, and each row's values
+are counted as one tuple with a Counter. Values that can't be hashed (lists
+and dicts) are counted by a frozen copy of themselves.
+
+Columns are named by attribute path, like "properties.location_type". A path
+may end in ":day", ":month" or ":year" to bucket an ISO8601 date/time value, as
+in "created_datetime:day". A path that starts with the name of a join (e.g.
+"place.properties.CounDist" for submissions) looks the first segment up once
+per distinct value, and reads the rest of the path from the result.
+
+Usage:
+
+    aggregate.py config.json comments --by place.properties.CounDist --by created_datetime:day
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+from argparse import ArgumentParser
+from collections import Counter
+import csv
+import json
+import sys
+
+from sorting import sort_key
+
+
+DATE_BUCKETS = {'day': 10, 'month': 7, 'year': 4}
+
+
+def resolve_path(record, segments):
+    for segment in segments:
+        if record is None:
+            return None
+        if isinstance(record, (list, tuple)):
+            try:
+                record = record[int(segment)]
+            except (ValueError, IndexError):
+                return None
+        else:
+            try:
+                record = record[segment]
+            except (KeyError, TypeError):
+                return None
+    return record
+
+
+def parse_column(spec):
+    """
+    Split a column spec into its path segments and its date bucket length (or
+    None if it's not bucketed).
+    """
+    path, _, bucket = spec.partition(':')
+    if bucket and bucket not in DATE_BUCKETS:
+        raise ValueError('Unknown date bucket %r in column %r; expected one of %s.' % (bucket, spec, ', '.join(sorted(DATE_BUCKETS))))
+    return path.split('.'), DATE_BUCKETS.get(bucket)
+
+
+class ColumnTable (object):
+    """
+    A set of equal-length columns of values, keyed by column spec.
+    """
+    def __init__(self, columns, length):
+        self.columns = columns
+        self.length = length
+
+    @classmethod
+    def from_records(cls, records, specs, joins={}):
+        """
+        Build a table with a column for each spec from the given records (a
+        sequence of dicts). joins maps the first segment of a path to a
+        function that looks up the record to read the rest of the path from.
+        """
+        records = list(records)
+        columns = {}
+        for spec in specs:
+            segments, bucket_len = parse_column(spec)
+
+            if segments[0] in joins:
+                column = joined_column(records, segments[0], segments[1:], joins[segments[0]])
+            else:
+                column = [resolve_path(record, segments) for record in records]
+
+            if bucket_len is not None:
+                column = bucket_column(column, bucket_len)
+            columns[spec] = column
+
+        return cls(columns, len(records))
+
+    def count_by(self, *specs):
+        """
+        Count the rows for every combination of values in the given columns.
+        Returns a list of (values, count) pairs, most frequent first.
+        """
+        columns = [self.columns[spec] for spec in specs]
+        try:
+            counts = Counter(zip(*columns))
+        except TypeError:
+            counts = Counter(zip(*[[hashable(value) for value in column] for column in columns]))
+
+        return sorted(counts.items(), key=lambda pair: (-pair[1], [sort_key(value) for value in pair[0]]))
+
+
+def hashable(value):
+    """
+    Get a hashable copy of a value, with lists as tuples and dicts as tuples
+    of their (sorted) items.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(hashable(elem) for elem in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, hashable(elem)) for key, elem in value.items()))
+    return value
+
+
+def joined_column(records, join_name, segments, lookup):
+    # Look each distinct key up only once.
+    looked_up = {}
+    column = []
+    for record in records:
+        key = resolve_path(record, [join_name])
+        if key is None:
+            column.append(None)
+            continue
+        key = hashable(key)
+        if key not in looked_up:
+            looked_up[key] = resolve_path(lookup(key), segments)
+        column.append(looked_up[key])
+    return column
+
+
+def bucket_column(column, bucket_len):
+    return ['' if value is None else ('%s' % (value,))[:bucket_len] for value in column]
+
+
+def count_records(records, specs, joins={}):
+    """
+    Count the records by the given column specs. Returns a list of dicts, each
+    with the combination of 'values' and its 'count' and 'percentage'.
+    """
+    table = ColumnTable.from_records(records, specs, joins)
+    return [
+        {'values': list(values),
+         'count': count,
+         'percentage': int(round(100.0 * count / table.length))}
+        for values, count in table.count_by(*specs)
+    ]
+
+
+def write_counts(counts, specs, outfile, format='csv'):
+    if format == 'json':
+        json.dump([dict(list(zip(specs, row['values'])) + [('count', row['count'])]) for row in counts], outfile, indent=2)
+        outfile.write('\n')
+    else:
+        writer = csv.writer(outfile)
+        writer.writerow(list(specs) + ['count'])
+        for row in counts:
+            writer.writerow(list(row['values']) + [row['count']])
+
+
+def main(config, set_name, specs, format='csv'):
+    from shareabouts_tool import ShareaboutsTool
+    import pytz
+
+    if 'username' in config and 'password' in config:
+        auth_info = (config['username'], config['password'])
+    else:
+        auth_info = None
+
+    tzname = config.get('timezone') or None
+    try:
+        localtz = pytz.timezone(tzname) if tzname else pytz.utc
+    except pytz.exceptions.UnknownTimeZoneError:
+        print ('I do not recognize the timezone "%s".' % tzname)
+        print ('To see a list of common timezone names, run '
+               '"common_timezones.py".')
+        return 1
+
+    # Only the fields that are bucketed by date need their times converted.
+    time_fields = set(parse_column(spec)[0][-1] for spec in specs if parse_column(spec)[1] is not None)
+
+    # Download the data
+    tool = ShareaboutsTool(config['host'], auth=auth_info)
+    joins = {}
+    if set_name == 'places' or any(spec.startswith('place.') for spec in specs):
+        places = [place.serialize() for place in tool.get_places(config['owner'], config['dataset'])]
+        tool.convert_times(places, localtz, time_fields)
+        places_by_url = dict((place['properties'].get('url'), place) for place in places)
+        joins['place'] = places_by_url.get
+
+    if set_name == 'places':
+        records = places
+    else:
+        records = [submission.serialize() for submission in tool.get_submissions(config['owner'], config['dataset'], set_names=[set_name])]
+        tool.convert_times(records, localtz, time_fields)
+
+    counts = count_records(records, specs, joins)
+    write_counts(counts, specs, sys.stdout, format)
+    return 0
+
+
+def cli(argv=None, prog=None):
+    parser = ArgumentParser(prog=prog, description='Count the places or submissions in a dataset by their attributes.')
+    parser.add_argument('configuration', help='The dataset configuration file name')
+    parser.add_argument('set_name', help='The set to count ("places", or the name of a submission set)')
+    parser.add_argument('--by', dest='specs', action='append', required=True, help='A column to count by, like properties.location_type or created_datetime:day. May be given more than once.')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv', help='The output format')
+
+    args = parser.parse_args(argv)
+    config = json.load(open(args.configuration))
+
+    result = main(config, args.set_name, args.specs, format=args.format) or 0
+    return result
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time how long shareabouts-tool takes to start up, by running
+"shareabouts-tool <command> --help" for each command a number of times, and
+printing the median and slowest times. Use --importtime to also print the
+slowest imports of each command (Python 3.7+).
+
+Run this before and after changing what the tools import at the top of their
+modules, to keep the startup from creeping up.
+"""
+
+from __future__ import print_function, unicode_literals, division
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+import time
+
+TOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shareabouts-tool')
+COMMANDS = ['', 'upload', 'summarize', 'dump', 'aggregate', 'clear', 'inspect', 'timezones']
+
+
+def time_command(command, runs):
+    argv = [sys.executable, TOOL] + ([command, '--help'] if command else ['--help'])
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call(argv, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2], times[-1]
+
+
+def get_slowest_imports(command, limit):
+    argv = [sys.executable, '-X', 'importtime', TOOL] + ([command, '--help'] if command else ['--help'])
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.Popen(argv, stdout=devnull, stderr=subprocess.PIPE).communicate()[1].decode('utf-8')
+
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len('import time:'):].split('|', 2)]
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:limit]
+
+
+def main(commands, runs, importtime=False):
+    print('%-11s %10s %10s' % ('command', 'median ms', 'max ms'))
+    for command in commands:
+        median, slowest = time_command(command, runs)
+        print('%-11s %10.1f %10.1f' % (command or '(usage)', median * 1000, slowest * 1000))
+
+        if importtime:
+            for cumulative, name in get_slowest_imports(command, 5):
+                print('    %8.1f ms  %s' % (cumulative / 1000, name))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Time the startup of each of the shareabouts-tool commands.')
+    parser.add_argument('commands', nargs='*', help='The commands to time (default all of them)')
+    parser.add_argument('--runs', type=int, default=10, help='The number of times to run each command (default 10)')
+    parser.add_argument('--importtime', action='store_true', help='Also print the slowest imports of each command')
+
+    args = parser.parse_args()
+    main(args.commands or COMMANDS, args.runs, importtime=args.importtime)
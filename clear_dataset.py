@@ -3,8 +3,10 @@
 
 from __future__ import print_function, unicode_literals, division
 from shareabouts_tool import ShareaboutsTool
+from record_filters import compile_filter, quote_literal, FilterError
 from argparse import ArgumentParser
 import json
+import sys
 
 spinner_frames = '\|/―'
 step = 0
@@ -22,56 +24,75 @@ def place_done_callback(place, place_response):
 
     step += 1
 
-def place_matches_filters(place, included_attributes=[], restricted_attributes=[], eq_attribute_values={}, ne_attribute_values={}):
-    for attr in included_attributes:
-        if attr not in place:
-            return False
-    for attr in restricted_attributes:
-        if attr in place:
-            return False
-    for attr, val in eq_attribute_values.items():
-        if place.get(attr, None) != val:
-            return False
-    for attr, val in ne_attribute_values.items():
-        if place.get(attr, None) == val:
-            return False
-    return True
-
-def main(config, delete=True, included_attributes=[], restricted_attributes=[], eq_attribute_values={}, ne_attribute_values={}):
+def get_filter_clauses(included_attributes=None, restricted_attributes=None, eq_attribute_values=None, ne_attribute_values=None):
+    """
+    Turn the attribute filters into record_filters clauses.
+    """
+    clauses = []
+    clauses.extend('%s exists' % (attr,) for attr in (included_attributes or []))
+    clauses.extend('%s missing' % (attr,) for attr in (restricted_attributes or []))
+    clauses.extend('%s=%s' % (attr, quote_literal(val)) for attr, val in sorted((eq_attribute_values or {}).items()))
+    clauses.extend('%s!=%s' % (attr, quote_literal(val)) for attr, val in sorted((ne_attribute_values or {}).items()))
+    return clauses
+
+def main(config, delete=True, included_attributes=None, restricted_attributes=None, eq_attribute_values=None, ne_attribute_values=None, where=None):
+    clauses = get_filter_clauses(
+        included_attributes, restricted_attributes,
+        eq_attribute_values, ne_attribute_values) + list(where or [])
+    try:
+        place_matches_filters = compile_filter(clauses)
+    except FilterError as e:
+        print(e)
+        return 1
+
     tool = ShareaboutsTool(config['host'])
-    all_places = [
-        place for place in
-        tool.get_places(config['owner'], config['dataset'])
-        #...put a condition here to filter the places, if desired...
-        if place_matches_filters(
-            place, included_attributes, restricted_attributes,
-            eq_attribute_values, ne_attribute_values)
-    ]
+    num_places = 0
+    all_places = []
+    for place in tool.get_places(config['owner'], config['dataset']):
+        num_places += 1
+        if place_matches_filters(place):
+            all_places.append(place)
+
+    if clauses:
+        print('%s of %s places match %s' % (len(all_places), num_places, ' and '.join(clauses)))
+
+    if not delete:
+        print('Not deleting the %s places (test run).' % (len(all_places),))
+        return 0
 
     print('Deleting the %s places...' % (len(all_places),))
 
-    if delete:
-        tool.delete_places(
-            config['owner'], config['dataset'], config['key'],
-            all_places, place_done_callback)
+    tool.delete_places(
+        config['owner'], config['dataset'], config['key'],
+        all_places, place_done_callback)
 
     print('\nDone!')
+    return 0
 
-if __name__ == '__main__':
-    parser = ArgumentParser(description='Remove all places from a dataset.')
+def cli(argv=None, prog=None):
+    parser = ArgumentParser(prog=prog, description='Remove all places from a dataset.')
     parser.add_argument('configuration', type=str, help='The configuration file name')
-    parser.add_argument('--test', '--no-delete', dest='delete', action='store_false', help='Actually delete the places?')
+    parser.add_argument('--test', '--no-delete', dest='delete', action='store_false', help='Only report how many places match, without deleting them')
     parser.add_argument('--has-attr', nargs='*', help='Delete items that have the attribute(s)')
     parser.add_argument('--wo-attr', nargs='*', help='Delete items that do not have the attribute(s)')
     parser.add_argument('--attr-is', nargs='*', help='Delete items that have the specific attribute values')
     parser.add_argument('--attr-not', nargs='*', help='Delete items that do not have the specific attribute values')
+    parser.add_argument('--where', nargs='*', help='Delete items that match the filter(s), like properties.source=import-2016 or "created_datetime>=2016-01-01" (see record_filters.py)')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     config = json.load(open(args.configuration))
 
-    main(
+    def parse_attribute_values(items):
+        return dict([item.split('=', 1) for item in items or []])
+
+    result = main(
         config, delete=args.delete,
         included_attributes=args.has_attr, restricted_attributes=args.wo_attr,
-        eq_attribute_values=dict([item.split('=') for item in args.attr_is]),
-        ne_attribute_values=dict([item.split('=') for item in args.attr_not]),
-    )
+        eq_attribute_values=parse_attribute_values(args.attr_is),
+        ne_attribute_values=parse_attribute_values(args.attr_not),
+        where=args.where,
+    ) or 0
+    return result
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -1,8 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import pytz
+from __future__ import print_function
+from argparse import ArgumentParser
+import sys
 
-if __name__ == '__main__':
+
+def cli(argv=None, prog=None):
+    parser = ArgumentParser(prog=prog, description='List the common timezone names.')
+    parser.parse_args(argv)
+
+    import pytz
     for tzname in pytz.common_timezones:
         print (tzname)
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+"""
+A compact, read-only form for large amounts of serialized Shareabouts data
+(places and submissions), for when the plain nested dicts take up too much
+memory.
+
+  * Each dict becomes a record with __slots__, holding a tuple of its values
+    and sharing the tuple of its keys with every other record that has the
+    same keys.
+  * Keys, and the values of fields that repeat (such as category names), are
+    interned, so that each distinct string is only held once. Fields whose
+    values are mostly distinct (such as URLs and timestamps) aren't, since
+    there'd be nothing to share.
+  * Geometry coordinates are held in arrays of doubles, and are unpacked
+    into nested tuples (once) when they're first read.
+  * Lists become tuples.
+
+A Compactor holds the table of interned strings and the shared record keys,
+and is meant to be used for one load of data, so that they go away with it.
+
+Records are read-only mappings, so templates, the handlebars helpers and the
+rest of the tools read them as they would the dicts. Their copy() method
+returns a plain (mutable, shallow) dict.
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+from array import array
+
+try:
+    # Python 3
+    from collections.abc import Mapping
+except ImportError:
+    # Python 2
+    from collections import Mapping
+
+try:
+    # Python 2
+    str_base = basestring
+except NameError:
+    # Python 3
+    str_base = str
+
+
+# Strings longer than this are unlikely to be repeated (e.g. descriptions and
+# comments), so they're not worth keeping in the intern table.
+MAX_INTERNED_LENGTH = 256
+
+# After this many values of a field, stop interning its new values if most of
+# them have been distinct.
+FIELD_SAMPLE_SIZE = 1000
+MAX_DISTINCT_SHARE = 0.5
+
+# The geometry types are mapped to themselves, so that every geometry shares
+# one copy of its type's name.
+GEOMETRY_TYPES = dict((name, name) for name in ['Point', 'MultiPoint', 'LineString', 'MultiLineString', 'Polygon', 'MultiPolygon'])
+
+
+class Shape (object):
+    """
+    The keys of a kind of record, in order, and the index of each.
+    """
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = dict((key, position) for position, key in enumerate(keys))
+
+    def __reduce__(self):
+        # Pickled once, and shared by the records that follow it in the same
+        # pickle.
+        return (Shape, (self.keys,))
+
+
+def make_record(cls, shape, values):
+    record = cls.__new__(cls)
+    record._shape = shape
+    record._values = values
+    return record
+
+
+class CompactRecord (Mapping):
+    __slots__ = ('_shape', '_values')
+
+    def __getitem__(self, key):
+        try:
+            position = self._shape.index[key]
+        except (KeyError, TypeError):
+            raise KeyError(key)
+        return self._values[position]
+
+    def __contains__(self, key):
+        try:
+            return key in self._shape.index
+        except TypeError:
+            return False
+
+    def __iter__(self):
+        return iter(self._shape.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self._shape.keys)
+
+    def copy(self):
+        return dict(zip(self._shape.keys, self._values))
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.copy())
+
+    def __reduce__(self):
+        # Pickle the keys once per shape rather than once per record.
+        return (make_record, (type(self), self._shape, self._values))
+
+
+class CompactFeature (CompactRecord):
+    """
+    A record for a place (a GeoJSON feature) that, like the place models from
+    the API, also looks up keys that aren't its own in its properties.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return CompactRecord.__getitem__(self, key)
+        except KeyError:
+            properties = CompactRecord.get(self, 'properties')
+            if properties is not None and key in properties:
+                return properties[key]
+            raise
+
+    def __contains__(self, key):
+        if CompactRecord.__contains__(self, key):
+            return True
+        properties = CompactRecord.get(self, 'properties')
+        return properties is not None and key in properties
+
+
+class PackedPositions (object):
+    """
+    A list of positions (coordinate pairs or triples), packed into one array.
+    """
+    __slots__ = ('dims', 'values')
+
+    def __init__(self, positions):
+        self.dims = len(positions[0]) if positions else 2
+        self.values = array(str('d'), [coord for position in positions for coord in position])
+
+    def unpack(self):
+        values = self.values.tolist()
+        return [values[start:start + self.dims] for start in range(0, len(values), self.dims)]
+
+    def __reduce__(self):
+        return (PackedPositions, (self.unpack(),))
+
+
+def is_position(value):
+    return (isinstance(value, (list, tuple)) and len(value) >= 2 and
+            all(isinstance(coord, (int, float)) and not isinstance(coord, bool) for coord in value))
+
+
+def pack_coordinates(coordinates):
+    if is_position(coordinates):
+        return array(str('d'), coordinates)
+    if isinstance(coordinates, (list, tuple)) and coordinates and all(is_position(position) for position in coordinates):
+        return PackedPositions(coordinates)
+    if isinstance(coordinates, (list, tuple)):
+        return tuple(pack_coordinates(part) for part in coordinates)
+    raise ValueError('Unexpected geometry coordinates: %r' % (coordinates,))
+
+
+def unpack_coordinates(packed):
+    if isinstance(packed, array):
+        return tuple(packed)
+    if isinstance(packed, PackedPositions):
+        return tuple(tuple(position) for position in packed.unpack())
+    return tuple(unpack_coordinates(part) for part in packed)
+
+
+class CompactGeometry (Mapping):
+    """
+    A GeoJSON geometry with its coordinates packed into arrays. The
+    coordinates are unpacked into nested tuples the first time they're read,
+    and the same tuples are returned after that.
+    """
+    __slots__ = ('_type', '_coordinates', '_unpacked')
+
+    keys_tuple = ('type', 'coordinates')
+
+    def __init__(self, geometry):
+        self._type = GEOMETRY_TYPES.get(geometry['type'], geometry['type'])
+        self._coordinates = pack_coordinates(geometry['coordinates'])
+        self._unpacked = None
+
+    def __getitem__(self, key):
+        if key == 'type':
+            return self._type
+        if key == 'coordinates':
+            if self._unpacked is None:
+                self._unpacked = unpack_coordinates(self._coordinates)
+            return self._unpacked
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.keys_tuple)
+
+    def __len__(self):
+        return 2
+
+    def keys(self):
+        return list(self.keys_tuple)
+
+    def copy(self):
+        return {'type': self._type, 'coordinates': self['coordinates']}
+
+    def __repr__(self):
+        return 'CompactGeometry(%r)' % (self.copy(),)
+
+    def __reduce__(self):
+        return (CompactGeometry, (self.copy(),))
+
+
+def is_geometry(data):
+    return (len(data) == 2 and data.get('type') in GEOMETRY_TYPES and 'coordinates' in data)
+
+
+class Compactor (object):
+    """
+    Makes compact copies of serialized data, sharing one table of interned
+    strings, and one shape for each set of keys, between them. Use one for
+    each load of data.
+    """
+    def __init__(self):
+        self.strings = {}
+        self.shapes = {}
+
+        # The number of values, and of new distinct values, seen for each
+        # field, or None once the field's values have stopped being interned.
+        self.field_counts = {}
+
+    def get_shape(self, keys):
+        keys = tuple(keys)
+        try:
+            return self.shapes[keys]
+        except KeyError:
+            shape = self.shapes[keys] = Shape(keys)
+            return shape
+
+    def intern_key(self, key):
+        if isinstance(key, str_base):
+            return self.strings.setdefault(key, key)
+        return key
+
+    def intern_value(self, field, value):
+        if len(value) > MAX_INTERNED_LENGTH:
+            return value
+
+        counts = self.field_counts.setdefault(field, [0, 0])
+        interned = self.strings.get(value)
+        if interned is not None:
+            if counts is not None:
+                counts[0] += 1
+            return interned
+        if counts is None:
+            return value
+
+        counts[0] += 1
+        counts[1] += 1
+        if counts[0] >= FIELD_SAMPLE_SIZE and counts[1] > counts[0] * MAX_DISTINCT_SHARE:
+            self.field_counts[field] = None
+        self.strings[value] = value
+        return value
+
+    def compact(self, data, field=None):
+        """
+        Make a compact, read-only copy of some serialized data. field is the
+        key that the data is stored under, if any.
+        """
+        if isinstance(data, dict):
+            if is_geometry(data):
+                try:
+                    return CompactGeometry(data)
+                except ValueError:
+                    pass
+            keys = [self.intern_key(key) for key in data.keys()]
+            return make_record(CompactRecord, self.get_shape(keys), tuple(self.compact(data[key], key) for key in keys))
+        elif isinstance(data, (list, tuple)):
+            return tuple(self.compact(elem, field) for elem in data)
+        elif isinstance(data, str_base):
+            return self.intern_value(field, data)
+        else:
+            return data
+
+    def compact_place(self, place):
+        """
+        Make a compact copy of a serialized place, which also looks up keys in
+        its properties (see CompactFeature).
+        """
+        record = self.compact(place)
+        return make_record(CompactFeature, record._shape, record._values)
+
+
+def compact(data):
+    """
+    Make a compact, read-only copy of some serialized data.
+    """
+    return Compactor().compact(data)
+
+
+def compact_place(place):
+    return Compactor().compact_place(place)
+
+
+def json_default(obj):
+    """
+    Serialize compact data with json.dumps(..., default=json_default).
+    """
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if isinstance(obj, array):
+        return obj.tolist()
+    return '%s' % (obj,)
@@ -66,21 +66,34 @@ For example, your templates/ds.json file may look something like:
         ]
     }
 }
+
+Several sets can be dumped at once (e.g. `--set_name places comments`). All of
+the snapshots are requested up front, and each set is then downloaded and
+transformed in its own process, into its own file: the set's "outfile" from
+its *_csv config if there is one, or else the --outfile pattern (by default
+"{set_name}.csv").
+
+For very large snapshots, `--shards N` downloads each snapshot to a temporary
+file, splits it into N pieces on row boundaries, and transforms the pieces in
+a pool of processes. The pieces are merged back together in order, or, with
+`--shard-files`, written to numbered files of their own. The --shard-files
+pattern has to include {shard}, and {set_name} too when several sets are
+dumped, so that no two shards are written to the same file.
 """
 
 from __future__ import print_function, unicode_literals, division
 
-from shareabouts_tool import ShareaboutsTool
+from shareabouts_tool import ShareaboutsTool, iter_csv_lines, convert_time_string, SNAPSHOT_CHUNK_SIZE
+from report_state import ReportState, get_state_filename, utc_sort_key, format_utc_sort_key
 from argparse import ArgumentParser
 import csv
+import gzip
 import json
-import pytz
+import operator
+import os
+import shutil
 import sys
-
-try:
-    from cStringIO import StringIO
-except:
-    from StringIO import StringIO
+import tempfile
 
 try:
     # Python 2
@@ -94,22 +107,417 @@ UNDEFINED = object()
 dataset = None
 
 
+def normalize_bound(value, localtz):
+    """
+    Turn a begin or end date/time given in the local timezone (unless it has
+    an offset of its own) into a UTC sort key, once, so that rows can be
+    compared against it without converting them. Returns None for a bound
+    that's outside the range of representable dates, i.e. no bound at all.
+    """
+    if not value:
+        return None
 
-
-def main(config, report, set_name, force_new=False):
-    csv_config = report.get('%s_csv' % (set_name,), {})
-
-    # csv_infilename = csv_config.get('infile')
-    # assert csv_infilename, 'No input file specified'
-
+    from dateutil import parser
+    import pytz
+    dt = parser.parse(value)
+    try:
+        if dt.tzinfo is None:
+            dt = localtz.localize(dt)
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    except OverflowError:
+        return None
+    return format_utc_sort_key(dt)
+
+
+def compile_field_getter(fieldname, index):
+    """
+    Make a function that gets a field's value from a snapshot row (a list).
+    Nested names like "submitter.name" are usually columns of their own; if
+    not, they're read from the JSON in the column named by their longest
+    prefix (e.g. "submitter"). Returns None if there's no such field.
+    """
+    if fieldname in index:
+        return operator.itemgetter(index[fieldname])
+
+    segments = fieldname.split('.')
+    for split_at in range(len(segments) - 1, 0, -1):
+        prefix = '.'.join(segments[:split_at])
+        if prefix in index:
+            column, path = index[prefix], segments[split_at:]
+            def get_nested(row):
+                try:
+                    value = json.loads(row[column])
+                    for segment in path:
+                        value = value[int(segment)] if isinstance(value, list) else value[segment]
+                except (ValueError, KeyError, IndexError, TypeError):
+                    return ''
+                return '' if value is None else value
+            return get_nested
+    return None
+
+
+def compile_projection(fieldnames, field_map={}, field_order=None):
+    """
+    Compile the field_map and field_order from a CSV config against the
+    snapshot's header into a function that turns a snapshot row into an
+    output row (both lists). For each output field, the value comes from the
+    last of the fields mapped onto it that has a value, or else from the
+    snapshot's own column of that name (unless that column was mapped to
+    another field).
+    """
+    index = dict((fieldname, position) for position, fieldname in enumerate(fieldnames))
+
+    getters = []
+    for outfield in (field_order or fieldnames):
+        sources = [compile_field_getter(infield, index)
+                   for infield, mapped in field_map.items() if mapped == outfield]
+        sources = [source for source in reversed(sources) if source is not None]
+
+        fallback = None
+        if outfield in index and field_map.get(outfield, outfield) == outfield:
+            fallback = operator.itemgetter(index[outfield])
+
+        getters.append((sources, fallback))
+
+    if not getters:
+        return lambda row: []
+
+    # When every output field is just a column of the snapshot, pick them all
+    # out at once.
+    if all(not sources and fallback is not None for sources, fallback in getters):
+        positions = [index[outfield] for outfield in (field_order or fieldnames)]
+        if len(positions) == 1:
+            return lambda row: [row[positions[0]]]
+        pick = operator.itemgetter(*positions)
+        return lambda row: list(pick(row))
+
+    def project(row):
+        out_row = []
+        for sources, fallback in getters:
+            for source in sources:
+                value = source(row)
+                if value:
+                    break
+            else:
+                value = fallback(row) if fallback is not None else ''
+            out_row.append(value)
+        return out_row
+    return project
+
+
+def get_time_fields(csv_config, fieldnames):
+    """
+    Get the columns whose times should be converted to the local timezone:
+    the time_fields declared in the CSV config, or else every column whose
+    name ends in "datetime".
+    """
+    if 'time_fields' in csv_config:
+        return list(csv_config['time_fields'])
+    return [fieldname for fieldname in fieldnames if fieldname.endswith('datetime')]
+
+
+
+
+class RowTransform (object):
+    """
+    Filters, converts and remaps snapshot rows (lists in the order of the
+    snapshot's fieldnames). Calling it with a row returns the output row, or
+    None if the row is filtered out. If a watermark is given, rows that haven't
+    changed since it are filtered out, and new_watermark keeps track of the
+    latest change seen.
+
+    The created_datetime column is only needed to check the begin and end
+    dates or the watermark; an empty snapshot has no header at all, and
+    passes through without one.
+    """
+    def __init__(self, fieldnames, csv_config, localtz, begin_key=None, end_key=None, watermark=None, incremental=None):
+        self.width = len(fieldnames)
+        self.localtz = localtz
+        self.begin_key = begin_key
+        self.end_key = end_key
+        self.watermark = watermark
+        self.new_watermark = watermark
+        self.incremental = (watermark is not None) if incremental is None else incremental
+
+        self.created_index = fieldnames.index('created_datetime') if 'created_datetime' in fieldnames else None
+        if self.created_index is None and fieldnames and (begin_key or end_key or self.incremental):
+            raise ValueError('The snapshot has no created_datetime column to filter on.')
+        self.updated_index = fieldnames.index('updated_datetime') if 'updated_datetime' in fieldnames else None
+        self.time_indexes = [fieldnames.index(fieldname) for fieldname in get_time_fields(csv_config, fieldnames) if fieldname in fieldnames]
+
+        self.out_fieldnames = csv_config.get('field_order', fieldnames)
+        self.project = compile_projection(fieldnames, csv_config.get('field_map', {}), csv_config.get('field_order'))
+
+    def __call__(self, row):
+        if len(row) < self.width:
+            row = row + [''] * (self.width - len(row))
+
+        created_key = ''
+        if self.created_index is not None:
+            created_key = utc_sort_key(row[self.created_index])
+            if self.begin_key and created_key < self.begin_key:
+                return None
+            if self.end_key and created_key >= self.end_key:
+                return None
+
+        if self.incremental:
+            latest = created_key
+            if self.updated_index is not None:
+                latest = max(latest, utc_sort_key(row[self.updated_index]))
+            if self.watermark is not None and latest <= self.watermark:
+                return None
+            self.new_watermark = max(self.new_watermark or '', latest)
+
+        for index in self.time_indexes:
+            if row[index]:
+                row[index] = convert_time_string(row[index], self.localtz)
+
+        return self.project(row)
+
+
+def get_tool(config):
     if 'username' in config and 'password' in config:
         auth_info = (config['username'], config['password'])
     else:
         auth_info = None
+    return ShareaboutsTool(config['host'], auth=auth_info)
+
+
+def dump_set(tool, config, report, set_name, snapshot_url, outfile, localtz, watermark=None, incremental=False, shards=None, shard_pattern=None, compress=False, processes=None):
+    """
+    Download the snapshot of one set and write it out as a clean CSV. Returns
+    the set's new watermark.
+    """
+    csv_config = report.get('%s_csv' % (set_name,), {})
+
+    # Download the data, a chunk at a time
+    csv_chunks = tool.wait_for_snapshot(config['owner'], config['dataset'], set_name, snapshot_url, format='csv', stream=True)
+
+    # Compare the raw (UTC) created times against the bounds, instead of
+    # converting every row before it's filtered.
+    begin_key = normalize_bound(report.get('begin_date'), localtz)
+    end_key = normalize_bound(report.get('end_date'), localtz)
+
+    if shards and shards > 1:
+        return dump_set_sharded(csv_chunks, set_name, csv_config, outfile, localtz, begin_key, end_key, watermark, incremental, shards, shard_pattern, compress, processes)
+
+    # Transform the CSV data, writing each row out as soon as it's read, so
+    # that the whole snapshot is never held in memory. The rows are read and
+    # written as lists, with the field mapping compiled against the header
+    # up front.
+    print ('Transforming the %s data...' % (set_name,), file=sys.stderr)
+    reader = csv.reader(iter_csv_lines(csv_chunks))
+    fieldnames = next(reader, [])
+
+    transform = RowTransform(fieldnames, csv_config, localtz, begin_key, end_key, watermark, incremental=incremental)
+
+    writer = csv.writer(outfile)
+    if transform.out_fieldnames:
+        writer.writerow(transform.out_fieldnames)
+    transform_rows(reader, transform, writer)
 
-    # Download the data
-    tool = ShareaboutsTool(config['host'], auth=auth_info)
-    csv_string = tool.get_snapshot(config['owner'], config['dataset'], set_name=set_name, format='csv', force_new=force_new)
+    return transform.new_watermark
+
+
+def transform_rows(reader, transform, writer):
+    for row in reader:
+        out_row = transform(row)
+        if out_row is not None:
+            writer.writerow(out_row)
+
+
+def find_row_boundaries(filename, num_shards, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    """
+    Split a CSV file into (up to) num_shards byte ranges of about the same
+    size, each starting and ending on a row boundary. A newline only ends a
+    row if it comes after an even number of quote characters, i.e. it's not
+    inside a quoted value (escaped quotes come in pairs, so they don't change
+    that). Returns the end of the header row, and the list of (start, end)
+    ranges that cover the rows after it.
+    """
+    size = os.path.getsize(filename)
+    boundaries = []
+    target = 0
+    in_quotes = False
+    offset = 0
+
+    with open(filename, 'rb') as infile:
+        while len(boundaries) < num_shards:
+            chunk = infile.read(chunk_size)
+            if not chunk:
+                break
+
+            scanned = 0
+            while len(boundaries) < num_shards and target < offset + len(chunk):
+                # Skip ahead to where the next boundary should be, keeping
+                # track of the quotes along the way.
+                start = max(target - offset, scanned)
+                in_quotes ^= bool(chunk.count(b'"', scanned, start) % 2)
+                scanned = start
+
+                # Then find the first newline from there that's not quoted.
+                found = None
+                while found is None:
+                    newline = chunk.find(b'\n', scanned)
+                    if newline == -1:
+                        break
+                    in_quotes ^= bool(chunk.count(b'"', scanned, newline) % 2)
+                    scanned = newline + 1
+                    if not in_quotes:
+                        found = offset + scanned
+                if found is None:
+                    break
+
+                boundaries.append(found)
+                if len(boundaries) == 1:
+                    shard_size = max((size - found) // num_shards, 1)
+                target = max(found, boundaries[0] + len(boundaries) * shard_size)
+
+            in_quotes ^= bool(chunk.count(b'"', scanned) % 2)
+            offset += len(chunk)
+
+    if not boundaries:
+        return size, []
+
+    header_end = boundaries[0]
+    ends = boundaries[1:]
+    if not ends or ends[-1] < size:
+        ends.append(size)
+    starts = [header_end] + ends[:-1]
+    return header_end, [(start, end) for start, end in zip(starts, ends) if end > start]
+
+
+def iter_file_range(filename, start, end, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    with open(filename, 'rb') as infile:
+        infile.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = infile.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def dump_set_sharded(csv_chunks, set_name, csv_config, outfile, localtz, begin_key, end_key, watermark, incremental, shards, shard_pattern=None, compress=False, processes=None):
+    """
+    Download a set's snapshot to a temporary file, split it into shards on
+    row boundaries, and transform the shards side by side in a pool of
+    processes. The shards are either written to numbered files of their own
+    (if a shard_pattern is given), or merged back into outfile in order.
+    Returns the set's new watermark.
+    """
+    import multiprocessing
+
+    print ('Downloading the %s data...' % (set_name,), file=sys.stderr)
+    fd, snapshot_filename = tempfile.mkstemp(suffix='.csv')
+    part_filenames = []
+    try:
+        with os.fdopen(fd, 'wb') as snapshot_file:
+            for chunk in csv_chunks:
+                snapshot_file.write(chunk)
+
+        header_end, ranges = find_row_boundaries(snapshot_filename, shards)
+        fieldnames = next(csv.reader(iter_csv_lines(iter_file_range(snapshot_filename, 0, header_end))), [])
+
+        # The transform is only built here to check the config against the
+        # header (and for its output fieldnames); each shard builds its own.
+        out_fieldnames = RowTransform(fieldnames, csv_config, localtz).out_fieldnames
+
+        jobs = []
+        for shard, (start, end) in enumerate(ranges):
+            if shard_pattern:
+                part_filename = get_outfilename(shard_pattern, set_name, compress, shard=shard)
+            else:
+                part_fd, part_filename = tempfile.mkstemp(suffix='.csv')
+                os.close(part_fd)
+            part_filenames.append(part_filename)
+            jobs.append((snapshot_filename, start, end, fieldnames, csv_config, localtz.zone,
+                         begin_key, end_key, watermark, incremental,
+                         part_filename, bool(shard_pattern), compress and bool(shard_pattern)))
+
+        print ('Transforming the %s data in %s shards...' % (set_name, len(jobs)), file=sys.stderr)
+        pool = multiprocessing.Pool(processes or min(len(jobs), multiprocessing.cpu_count()) or 1)
+        try:
+            shard_watermarks = pool.map(_transform_shard_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        if shard_pattern:
+            for part_filename in part_filenames:
+                print ('Wrote %s to %s' % (set_name, part_filename), file=sys.stderr)
+            part_filenames = []
+        else:
+            # Merge the shards back together, in order, after the header.
+            if out_fieldnames:
+                csv.writer(outfile).writerow(out_fieldnames)
+            outfile.flush()
+            out_buffer = getattr(outfile, 'buffer', outfile)
+            for part_filename in part_filenames:
+                with open(part_filename, 'rb') as part_file:
+                    shutil.copyfileobj(part_file, out_buffer)
+            out_buffer.flush()
+
+    finally:
+        os.remove(snapshot_filename)
+        if not shard_pattern:
+            for part_filename in part_filenames:
+                os.remove(part_filename)
+
+    shard_watermarks = [shard_watermark for shard_watermark in shard_watermarks if shard_watermark is not None]
+    return max(shard_watermarks) if shard_watermarks else watermark
+
+
+def _transform_shard_job(job):
+    import pytz
+    (snapshot_filename, start, end, fieldnames, csv_config, tzname,
+     begin_key, end_key, watermark, incremental,
+     outfilename, write_header, compress) = job
+
+    transform = RowTransform(fieldnames, csv_config, pytz.timezone(tzname), begin_key, end_key, watermark, incremental=incremental)
+    reader = csv.reader(iter_csv_lines(iter_file_range(snapshot_filename, start, end)))
+    with open_outfile(outfilename, compress) as outfile:
+        writer = csv.writer(outfile)
+        if write_header and transform.out_fieldnames:
+            writer.writerow(transform.out_fieldnames)
+        transform_rows(reader, transform, writer)
+    return transform.new_watermark
+
+
+def _dump_set_job(job):
+    # Each set is downloaded and transformed in its own worker process, with
+    # its own connection to the API.
+    import pytz
+    config, report, set_name, snapshot_url, outfilename, tzname, watermark, incremental, compress = job
+    localtz = pytz.timezone(tzname)
+    with open_outfile(outfilename, compress) as outfile:
+        new_watermark = dump_set(get_tool(config), config, report, set_name, snapshot_url, outfile, localtz, watermark, incremental)
+    print ('Wrote %s to %s' % (set_name, outfilename), file=sys.stderr)
+    return new_watermark
+
+
+def get_outfilename(pattern, set_name, compress=False, shard=None):
+    outfilename = pattern.format(set_name=set_name, shard=shard)
+    if compress and not outfilename.endswith('.gz'):
+        outfilename += '.gz'
+    return outfilename
+
+
+def open_outfile(outfilename, compress=False):
+    if compress:
+        if bytes is str:
+            return gzip.open(outfilename, 'wb')
+        return gzip.open(outfilename, 'wt', newline='', encoding='utf-8')
+    if bytes is str:
+        return open(outfilename, 'wb')
+    return open(outfilename, 'w', newline='', encoding='utf-8')
+
+
+def main(config, report, set_names, force_new=False, outfile_pattern=None, processes=None, shards=None, shard_pattern=None, compress=False):
+    import pytz
+    if isinstance(set_names, str_type):
+        set_names = [set_names]
 
     # Convert times to local timezone
     tzname = config.get('timezone') or report.get('timezone') or None
@@ -121,55 +529,112 @@ def main(config, report, set_name, force_new=False):
                '"common_timezones.py".')
         return 1
 
-    begin_dt = report.get('begin_date')
-    end_dt = report.get('end_date')
-
-    # Transform the CSV data
-    print ('Transforming the data...', file=sys.stderr)
-    infile = StringIO(csv_string)
-    reader = csv.DictReader(infile)
-
-    data = []
-    for row in reader:
-        tool.convert_times(row, localtz)
-
-        if begin_dt and row['created_datetime'] < begin_dt:
-            continue
-        if end_dt and row['created_datetime'] >= end_dt:
-            continue
-
-        for infield, outfield in csv_config.get('field_map', {}).items():
-            if infield in row and row[infield]:
-                row[outfield] = row.pop(infield)
+    # Incremental dumps only include the rows that were created or updated
+    # since the last run of the report for each set. The watermarks are kept
+    # as UTC sort keys.
+    state = None
+    watermarks = {}
+    if report.get('incremental'):
+        assert report.get('state_file'), 'Incremental reports need a state_file (or run with --state-dir)'
+        state = ReportState(report['state_file'])
+        watermarks = state.get('watermarks', {})
+        for set_name in set_names:
+            print ('Dumping %s changed since %s' % (set_name, watermarks.get(set_name) or 'the beginning'), file=sys.stderr)
+
+    # Ask for all of the snapshots up front, so that the server can build them
+    # at the same time.
+    tool = get_tool(config)
+    snapshot_urls = [
+        tool.request_snapshot(config['owner'], config['dataset'], set_name=set_name, force_new=force_new)
+        for set_name in set_names]
+
+    def get_set_outfilename(set_name):
+        return get_outfilename(
+            report.get('%s_csv' % (set_name,), {}).get('outfile') or outfile_pattern or '{set_name}.csv',
+            set_name, compress)
+
+    if len(set_names) == 1 and not outfile_pattern:
+        # A single set goes to stdout
+        set_name, snapshot_url = set_names[0], snapshot_urls[0]
+        new_watermarks = [dump_set(tool, config, report, set_name, snapshot_url, sys.stdout, localtz, watermarks.get(set_name), incremental=(state is not None),
+                                   shards=shards, shard_pattern=shard_pattern, compress=compress, processes=processes)]
+
+    elif shards and shards > 1:
+        # Sharded sets already use all of the processes they're given, so
+        # take them one at a time.
+        new_watermarks = []
+        for set_name, snapshot_url in zip(set_names, snapshot_urls):
+            dump_args = (tool, config, report, set_name, snapshot_url)
+            dump_kwargs = dict(watermark=watermarks.get(set_name), incremental=(state is not None),
+                               shards=shards, shard_pattern=shard_pattern, compress=compress, processes=processes)
+            if shard_pattern:
+                new_watermarks.append(dump_set(*dump_args, outfile=None, localtz=localtz, **dump_kwargs))
+            else:
+                outfilename = get_set_outfilename(set_name)
+                with open_outfile(outfilename, compress) as outfile:
+                    new_watermarks.append(dump_set(*dump_args, outfile=outfile, localtz=localtz, **dump_kwargs))
+                print ('Wrote %s to %s' % (set_name, outfilename), file=sys.stderr)
 
-        data.append(row)
-
-    # Print the template, and send it where it needs to go
-    outfile = sys.stdout
-    writer = csv.DictWriter(outfile,
-        fieldnames=csv_config.get('field_order', reader.fieldnames),
-        extrasaction='ignore')
-    writer.writeheader()
-    writer.writerows(data)
+    else:
+        # Several sets each go to their own file, and are waited for and
+        # transformed side by side.
+        import multiprocessing
+        jobs = [
+            (config, report, set_name, snapshot_url, get_set_outfilename(set_name),
+             localtz.zone, watermarks.get(set_name), state is not None, compress)
+            for set_name, snapshot_url in zip(set_names, snapshot_urls)]
+
+        pool = multiprocessing.Pool(processes or len(jobs))
+        try:
+            new_watermarks = pool.map(_dump_set_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    if state is not None:
+        for set_name, new_watermark in zip(set_names, new_watermarks):
+            watermarks[set_name] = new_watermark
+        state.set('watermarks', watermarks)
+        state.save()
 
     return 0
 
-if __name__ == '__main__':
-    parser = ArgumentParser(description='Dump data from the Shareabouts API into a clean CSV.')
+def cli(argv=None, prog=None):
+    parser = ArgumentParser(prog=prog, description='Dump data from the Shareabouts API into a clean CSV.')
     parser.add_argument('configuration', help='The dataset access configuration file name')
     parser.add_argument('report', help='The report/data output configuration file name')
-    parser.add_argument('--set_name', help='The name of the set to snapshot', default='places')
+    parser.add_argument('--set_name', help='The name(s) of the set(s) to snapshot', nargs='+', default=['places'])
+    parser.add_argument('--outfile', dest='outfile_pattern', help='The file to write each set to, with {set_name} standing for the set\'s name. Defaults to stdout for one set, or {set_name}.csv for several.')
+    parser.add_argument('--processes', type=int, help='The number of sets (or shards, with --shards) to transform at a time. Defaults to all of the sets, or one shard per CPU.')
+    parser.add_argument('--shards', type=int, help='Download each snapshot to a temporary file, split it into this many shards, and transform the shards in parallel. Meant for very large snapshots.')
+    parser.add_argument('--shard-files', dest='shard_pattern', help='Write each shard to a numbered file of its own instead of merging them, with {set_name} and {shard} standing for the set\'s name and the shard\'s number, e.g. "{set_name}-{shard:03d}.csv".')
+    parser.add_argument('--gzip', dest='compress', action='store_true', default=False, help='Compress the output files with gzip (output to stdout is never compressed).')
     parser.add_argument('--force_new', help='Force the API server to create a new snapshot', default=False, action='store_true')
+    parser.add_argument('--state-dir', dest='state_dir', help='A directory to keep the report\'s state between runs in, if it has no state_file of its own.')
     parser.add_argument('--begin', default='0001-01-01', help='The date/time from which you want results. Submissions on or after this date/time will be included.')
     parser.add_argument('--end', default='9999-12-31T23:59:59.999', help='The date/time until which you want results. Submissions before this date/time will be included.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if args.shard_pattern:
+        if '{shard' not in args.shard_pattern:
+            parser.error('--shard-files needs {shard} in its pattern, or every shard is written to the same file.')
+        if len(args.set_name) > 1 and '{set_name' not in args.shard_pattern:
+            parser.error('--shard-files needs {set_name} in its pattern when several sets are dumped, or the sets overwrite each other.')
+
     config = json.load(open(args.configuration))
     report = json.load(open(args.report))
 
+    state_filename = get_state_filename(report, args.report, args.state_dir, suffix='.dump-state.json')
+    if state_filename: report['state_file'] = state_filename
+
     if args.begin: report['begin_date'] = args.begin
     if args.end: report['end_date'] = args.end
 
     # main(config, args.template, args.begin, args.end)
-    result = main(config, report, args.set_name, force_new=args.force_new) or 0
-    sys.exit(result)
+    result = main(config, report, args.set_name, force_new=args.force_new, outfile_pattern=args.outfile_pattern, processes=args.processes,
+                  shards=args.shards, shard_pattern=args.shard_pattern, compress=args.compress) or 0
+    return result
+
+if __name__ == '__main__':
+    sys.exit(cli())
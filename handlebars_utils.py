@@ -1,7 +1,120 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
-from pybars import strlist
-from pybars._compiler import resolve, _if, is_dictlike, is_iterable
+from sorting import sort_key
+
+# pybars is slow to import (it builds its grammar when it's loaded), so it's
+# only imported the first time it's needed, by load_pybars. Until then, each
+# of these names is a stand-in that loads pybars, which replaces it with the
+# real thing.
+pybars_loaded = False
+
+def load_pybars():
+    global pybars_loaded, Compiler, strlist, resolve, _if, is_dictlike, is_iterable
+    if not pybars_loaded:
+        import pybars
+        import pybars._compiler
+        Compiler = pybars.Compiler
+        strlist = pybars.strlist
+        resolve = pybars._compiler.resolve
+        _if = pybars._compiler._if
+        is_dictlike = pybars._compiler.is_dictlike
+        is_iterable = pybars._compiler.is_iterable
+        pybars_loaded = True
+
+def _load_on_first_use(name):
+    def stand_in(*args, **kwargs):
+        load_pybars()
+        return globals()[name](*args, **kwargs)
+    stand_in.__name__ = str(name)
+    return stand_in
+
+Compiler = _load_on_first_use('Compiler')
+strlist = _load_on_first_use('strlist')
+resolve = _load_on_first_use('resolve')
+_if = _load_on_first_use('_if')
+is_dictlike = _load_on_first_use('is_dictlike')
+is_iterable = _load_on_first_use('is_iterable')
+
+def compile_template(template_source):
+    return Compiler().compile(template_source)
+
+try:
+    str_base = basestring
+except NameError:
+    str_base = str
+
+
+class LRUCache (object):
+    """
+    A small dict-like cache that holds on to at most maxsize entries,
+    forgetting the least recently used ones first.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return default
+        self._entries[key] = value
+        return value
+
+    def set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Results of sorting and grouping, keyed by the identity of the collection
+# they were computed from. Since the key is the collection's id, each entry
+# also keeps a reference to the collection so that the id can't be reused by
+# a different object while the entry is alive. Call clear_render_memo before
+# rendering a template over data that may have changed.
+render_memo = LRUCache(maxsize=64)
+
+def clear_render_memo():
+    render_memo.clear()
+
+def memoized(kind, iterable, attr_name, compute):
+    # Only memoize real collections; iterators would be used up by the first
+    # computation, and their ids say nothing about their contents.
+    if not isinstance(iterable, (list, tuple, dict)):
+        return compute()
+
+    key = (kind, id(iterable), attr_name)
+    entry = render_memo.get(key)
+    if entry is not None and entry[0] is iterable:
+        return entry[1]
+
+    result = compute()
+    render_memo.set(key, (iterable, result))
+    return result
+
+
+def split_place_args(this, args):
+    """
+    Split the arguments given to a helper like submissions_for_place into a
+    place and a submission set name. With one argument, it's the place if
+    it's dict-like or a URL (or missing), or else the set name, for the place
+    in the current scope.
+    """
+    if len(args) >= 2:
+        return args[0], args[1]
+    if len(args) == 1:
+        value = args[0]
+        if value is None or is_dictlike(value) or (isinstance(value, str_base) and '/' in value):
+            return value, None
+        return this, value
+    return this, None
 
 
 # Handlebars helpers
@@ -62,13 +175,36 @@ def _quoted(this, value):
     if value:
         return strlist(['"', value.replace('\\', '\\\\').replace('"', '\\"'), '"'])
 
+# Formatted date/time strings, keyed on the date/time portion of the value and
+# the format. A value of None means that the prefix could not be parsed.
+formatted_datetimes = LRUCache(maxsize=4096)
+_UNFORMATTED = object()
+
+def _parse_iso_prefix(prefix):
+    # Most values look exactly like "YYYY-MM-DDTHH:MM:SS", so pick the fields
+    # out by position. Anything else goes through strptime, which is slow but
+    # more forgiving.
+    if (len(prefix) == 19 and prefix[4] == '-' and prefix[7] == '-' and
+            prefix[10] == 'T' and prefix[13] == ':' and prefix[16] == ':'):
+        fields = (prefix[0:4], prefix[5:7], prefix[8:10],
+                  prefix[11:13], prefix[14:16], prefix[17:19])
+        if all(field.isdigit() for field in fields):
+            return datetime(*[int(field) for field in fields])
+    return datetime.strptime(prefix, "%Y-%m-%dT%H:%M:%S")
+
 def _format(this, value, format):
     if value:
-        try:
-            dt = datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
-            return dt.strftime(format)
-        except ValueError:
-            pass
+        key = (value[:19], format)
+        formatted = formatted_datetimes.get(key, _UNFORMATTED)
+        if formatted is _UNFORMATTED:
+            try:
+                formatted = _parse_iso_prefix(key[0]).strftime(format)
+            except ValueError:
+                formatted = None
+            formatted_datetimes.set(key, formatted)
+
+        if formatted is not None:
+            return formatted
     return value
 
 # Usage: {{#filter_by [collection] attribute value}}
@@ -145,19 +281,30 @@ def _sort_by(this, options, *args):
     # Check the options for the function that generates an sort key. The
     # function should take two parameters (an element and the name of an
     # attribute) and generate a sort key.
+    # Results are only memoized for the default key maker, since a custom one
+    # may not be stable from one call to the next.
+    memo_kind = 'sort_by' if 'sort_key_maker' not in options else None
     sort_key_maker = options.get(
         'sort_key_maker',
         lambda elem, attr: resolve(elem, *attr.split('.'))
     )
 
-    reverse = False
-    if attr_name[0] == '-':
-        reverse = True
-        attr_name = attr_name[1:]
+    def sort_context():
+        reverse = False
+        sort_attr = attr_name
+        if sort_attr[0] == '-':
+            reverse = True
+            sort_attr = sort_attr[1:]
 
-    sorted_context = sorted(iterable, key=lambda elem: sort_key_maker(elem, attr_name))
-    if reverse:
-        sorted_context = reversed(sorted_context)
+        sorted_context = sorted(iterable, key=lambda elem: sort_key_maker(elem, sort_attr))
+        if reverse:
+            sorted_context.reverse()
+        return sorted_context
+
+    if memo_kind:
+        sorted_context = memoized(memo_kind, iterable, attr_name, sort_context)
+    else:
+        sorted_context = sort_context()
     return options['fn'](sorted_context)
 
 def _group_by(this, options, *args):
@@ -175,6 +322,10 @@ def _group_by(this, options, *args):
     # Check the options for the function that generates an group key. The
     # function should take two parameters (an element and the name of an
     # attribute) and generate a group key.
+    # Results are only memoized for the default key maker (or for a key maker
+    # that names its memo kind, like group_by_date's), since an arbitrary one
+    # may not be stable from one call to the next.
+    memo_kind = options.get('group_memo_kind', 'group_by' if 'group_key_maker' not in options else None)
     group_key_maker = options.get(
         'group_key_maker',
         lambda elem, attr: resolve(elem, *attr.split('.'))
@@ -185,14 +336,20 @@ def _group_by(this, options, *args):
         reverse = True
         attr_name = attr_name[1:]
 
-    grouped_context = defaultdict(list)
-    for elem in iterable:
-        group_key = group_key_maker(elem, attr_name)
-        try:
-            grouped_context[group_key].append(elem)
-        except TypeError as e:
-            raise TypeError('Attribute {!r} resolved to {}'.format(attr_name, e))
-
+    def group_context():
+        grouped_context = defaultdict(list)
+        for elem in iterable:
+            group_key = group_key_maker(elem, attr_name)
+            try:
+                grouped_context[group_key].append(elem)
+            except TypeError as e:
+                raise TypeError('Attribute {!r} resolved to {}'.format(attr_name, e))
+        return grouped_context
+
+    if memo_kind:
+        grouped_context = memoized(memo_kind, iterable, attr_name, group_context)
+    else:
+        grouped_context = group_context()
     return _each_sorted(this, options, grouped_context, reverse)
 
 def _group_by_date(this, options, *args):
@@ -200,8 +357,91 @@ def _group_by_date(this, options, *args):
     # the given attribute, as the first 10 characters in an ISO8601 formatted
     # date/time string represent the date portion.
     options['group_key_maker'] = lambda elem, attr: resolve(elem, *attr.split('.'))[:10]
+    options['group_memo_kind'] = 'group_by_date'
     return _group_by(this, options, *args)
 
+# Usage: {{#count_by [collection] attribute [limit]}}
+#          {{#each .}}{{value}}: {{count}} ({{percentage}}%){{/each}}
+#        {{/count_by}}
+def _count_by(this, options, *args):
+    # If the first argument is a string, it's the counting attribute name, and
+    # this will be used as the context (iterable). Otherwise, the first
+    # argument is the context, and the second is the counting attribute.
+    if args and isinstance(args[0], str_base):
+        iterable = this
+    elif len(args) >= 2:
+        iterable, args = args[0], args[1:]
+    else:
+        raise ValueError('count_by takes a collection, an attribute, and an optional limit.')
+    attr_name = args[0]
+    limit = int(args[1]) if len(args) > 1 else None
+
+    # Check the options for the function that generates a count key, and the
+    # order that the counts should come out in. By default, the most frequent
+    # values come first.
+    count_key_maker = options.get(
+        'count_key_maker',
+        lambda elem, attr: resolve(elem, *attr.split('.'))
+    )
+    count_order = options.get('count_order', lambda counts: sorted(counts, key=lambda value: (-counts[value], sort_key(value))))
+    memo_kind = options.get('count_memo_kind', 'count_by' if 'count_key_maker' not in options else None)
+
+    reverse = False
+    if attr_name[0] == '-':
+        reverse = True
+        attr_name = attr_name[1:]
+
+    # Count every value of the attribute in a single pass over the collection.
+    def count_context():
+        counts = defaultdict(int)
+        total = 0
+        for elem in iterable:
+            try:
+                counts[count_key_maker(elem, attr_name)] += 1
+            except TypeError as e:
+                raise TypeError('Attribute {!r} resolved to {}'.format(attr_name, e))
+            total += 1
+
+        return [
+            {'value': value,
+             'count': counts[value],
+             'percentage': int(round(100.0 * counts[value] / total))}
+            for value in count_order(counts)
+        ]
+
+    if memo_kind:
+        counted_context = memoized(memo_kind, iterable, attr_name, count_context)
+    else:
+        counted_context = count_context()
+
+    if reverse:
+        counted_context = counted_context[::-1]
+    if limit is not None:
+        counted_context = counted_context[:limit]
+
+    if len(counted_context) == 0:
+        return options['inverse'](this)
+
+    return options['fn'](counted_context)
+
+# Usage: {{#count_by_date [collection] attribute [day|month|year]}}
+#          {{#each .}}{{value}}: {{count}}{{/each}}
+#        {{/count_by_date}}
+def _count_by_date(this, options, *args):
+    # Bucket by a prefix of the ISO8601 formatted date/time string, and keep
+    # the buckets in chronological order.
+    bucket_lengths = {'day': 10, 'month': 7, 'year': 4}
+    if args and args[-1] in bucket_lengths:
+        bucket, args = args[-1], args[:-1]
+    else:
+        bucket = 'day'
+    prefix_len = bucket_lengths[bucket]
+
+    options['count_key_maker'] = lambda elem, attr: (resolve(elem, *attr.split('.')) or '')[:prefix_len]
+    options['count_order'] = sorted
+    options['count_memo_kind'] = 'count_by_date_' + bucket
+    return _count_by(this, options, *args)
+
 def _if_gte(this, options, val1, val2):
     return _if(this, options, lambda _: val1 >= val2)
 
@@ -266,6 +506,8 @@ helpers = {
     'sort_by': _sort_by,
     'group_by': _group_by,
     'group_by_date': _group_by_date,
+    'count_by': _count_by,
+    'count_by_date': _count_by_date,
     'if_lte': _if_lte,
     'if_gte': _if_gte,
     'if_equal': _if_equal,
@@ -294,3 +536,32 @@ if __name__ == '__main__':
     options = {'fn': (lambda x: (True, x)), 'inverse': (lambda x: (False, x))}
     items = [{'a': 1, 'b': 1}, {'a': 1, 'b': 2}, {'a': 2, 'b': 3}]
     r = _filter_by_any({}, options, items, 'b', 1, 2)
+
+    # Check that _sort_by reuses its result for the same collection
+    options = {'fn': (lambda x: x), 'inverse': (lambda x: None)}
+    items = [{'a': 2}, {'a': 3}, {'a': 1}]
+    r1 = _sort_by({}, dict(options), items, '-a')
+    r2 = _sort_by({}, dict(options), items, '-a')
+    assert_equal([item['a'] for item in r1], [3, 2, 1])
+    assert r1 is r2
+
+    # Check that _count_by counts every value in one pass
+    options = {'fn': (lambda x: x), 'inverse': (lambda x: None)}
+    items = [{'p': {'c': 'a'}}, {'p': {'c': 'b'}}, {'p': {'c': 'a'}}]
+    r = _count_by({}, dict(options), items, 'p.c')
+    assert_equal(r, [{'value': 'a', 'count': 2, 'percentage': 67},
+                     {'value': 'b', 'count': 1, 'percentage': 33}])
+    r = _count_by({}, dict(options), items, 'p.c', 1)
+    assert_equal([item['value'] for item in r], ['a'])
+
+    # Check that a single place argument is told apart from a set name
+    place = {'properties': {'url': 'http://example.com/places/1'}}
+    assert_equal(split_place_args(place, ['comments']), (place, 'comments'))
+    assert_equal(split_place_args({}, [place]), (place, None))
+    assert_equal(split_place_args({}, ['http://example.com/places/1']), ('http://example.com/places/1', None))
+    assert_equal(split_place_args(place, []), (place, None))
+
+    # Check that _count_by can order tied counts of numbers, strings and None
+    items = [{'a': 0}, {'a': 5}, {'a': 'x'}, {'a': None}]
+    r = _count_by({}, dict(options), items, 'a')
+    assert_equal([item['value'] for item in r], [0, 5, 'x', None])
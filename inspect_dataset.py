@@ -1,40 +1,63 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""
+Print a profile of the fields in a dataset's places and in each of its
+submission sets: the type of each field, how often it's empty, about how many
+distinct values it has, and a few example values. The records are fetched a
+page at a time, and each page is profiled and let go before the next one is
+fetched, so the whole dataset is never held in memory.
+"""
+
 from __future__ import print_function, unicode_literals, division
 from shareabouts_tool import ShareaboutsTool
-from argparse import ArgumentParser
+from schema_profile import SchemaProfiler, print_profile
+from argparse import ArgumentParser, ArgumentTypeError
 import json
-
-
-def main(config):
-    tool = ShareaboutsTool(config['host'])
-    all_places = tool.get_places(config['owner'], config['dataset'])
-    all_submissions = tool.get_submissions(config['owner'], config['dataset'])
-
-    place_fields = set()
-    for place in tool.api.account(config['owner']).dataset(config['dataset']).places:
-        place_fields.update(place._data['properties'].keys())
-
-    print('Place fields: ')
-    for field in place_fields:
-        print('  - %s' % (field,))
-
-    for sset in tool.api.account(config['owner']).dataset(config['dataset']).submission_sets:
-        submission_fields = set()
-
-        for submission in sset:
-            submission_fields.update(submission._data.keys())
-
-        print('%s fields:' % (sset.name.title(),))
-        for field in submission_fields:
-            print('  - %s' % (field,))
-
-if __name__ == '__main__':
-    parser = ArgumentParser(description='Print the number of places in a dataset.')
+import sys
+
+
+def main(config, sample_rate=1.0, set_names=None):
+    if 'username' in config and 'password' in config:
+        auth_info = (config['username'], config['password'])
+    else:
+        auth_info = None
+
+    tool = ShareaboutsTool(config['host'], auth=auth_info)
+
+    if set_names is None or 'places' in set_names:
+        places_url = tool.places_url_template % (config['owner'], config['dataset'])
+        print('Loading places from %s...' % (places_url,), file=sys.stderr)
+        profiler = SchemaProfiler(sample_rate)
+        for page in tool.iter_pages(places_url):
+            for place in page:
+                profiler.add(place.get('properties', {}))
+        print_profile('Place fields', profiler, sys.stdout)
+
+    for set_name, submissions_url in tool.iter_submission_set_urls(config['owner'], config['dataset'], set_names):
+        print('Loading submissions from %s...' % (submissions_url,), file=sys.stderr)
+        profiler = SchemaProfiler(sample_rate)
+        for page in tool.iter_pages(submissions_url):
+            for submission in page:
+                profiler.add(submission)
+        print_profile('%s fields' % (set_name.title(),), profiler, sys.stdout)
+
+def sample_rate_type(value):
+    rate = float(value)
+    if not 0 < rate <= 1:
+        raise ArgumentTypeError('%s is not a share of the records, greater than 0 and at most 1' % (value,))
+    return rate
+
+def cli(argv=None, prog=None):
+    parser = ArgumentParser(prog=prog, description='Print a profile of the fields in a dataset.')
     parser.add_argument('configuration', type=str, help='The configuration file name')
+    parser.add_argument('--sample', type=sample_rate_type, default=1.0, help='The share of the records to profile, greater than 0 and at most 1 (default 1, i.e. all of them)')
+    parser.add_argument('--set_name', nargs='+', help='The sets to profile ("places", and/or the names of submission sets). Defaults to all of them.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     config = json.load(open(args.configuration))
 
-    main(config)
\ No newline at end of file
+    main(config, sample_rate=args.sample, set_names=args.set_name)
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deliver report emails through Postmark (https://postmarkapp.com) from a
+background thread, so that rendering doesn't wait on the network. Emails are
+queued as they're rendered, and the sender sends whatever has built up in the
+queue in batches (within Postmark's limits on the number of messages and the
+size of a request), over one pooled HTTP session, retrying when the server
+can't be reached or has an error of its own.
+
+NOTE: Remember, you must register your sender email addresses with
+      Postmark: https://postmarkapp.com/signatures
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+from shareabouts_tool import get_requests
+import json
+import sys
+import threading
+import time
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+POSTMARK_API_ROOT = 'https://api.postmarkapp.com'
+
+
+class PostmarkSender (threading.Thread):
+    # Postmark accepts up to 500 messages, and up to 50 MB, in a single batch
+    # request. Leave some room under the size limit for the request itself.
+    max_batch_size = 500
+    max_batch_bytes = 45 * 1024 * 1024
+
+    def __init__(self, token, api_root=POSTMARK_API_ROOT, max_retries=5, timeout=60):
+        self.token = token
+        self.api_root = api_root.rstrip('/')
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.queue = Queue()
+        self.session = get_requests().Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Content-type': 'application/json',
+            'X-Postmark-Server-Token': token
+        })
+
+        self.num_sent = 0
+        self.num_failed = 0
+        self.error = None
+
+        super(PostmarkSender, self).__init__()
+        self.daemon = True
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['postmarkapp_token'], api_root=config.get('postmarkapp_api_root', POSTMARK_API_ROOT))
+
+    def send(self, email, on_sent=None):
+        """
+        Queue an email (a dict in Postmark's format) to be sent. If on_sent is
+        given, it's called (from the sender's thread) once the email has been
+        delivered.
+        """
+        self.queue.put((email, on_sent))
+
+    def close(self):
+        """
+        Send everything that's left in the queue, and stop the sender. Raises
+        a RuntimeError if the sender stopped early, with emails left unsent.
+        """
+        self.queue.put(None)
+        self.join()
+        self.session.close()
+
+        if self.error is not None:
+            num_unsent = 0
+            while not self.queue.empty():
+                if self.queue.get() is not None:
+                    num_unsent += 1
+            self.num_failed += num_unsent
+            raise RuntimeError('The email sender stopped with an error (%s); %s queued email(s) were not sent.' % (self.error, num_unsent))
+
+    def run(self):
+        try:
+            self.send_queued()
+        except Exception as e:
+            print('The email sender stopped with an error: %r' % (e,), file=sys.stderr)
+            self.error = e
+
+    def send_queued(self):
+        stopping = False
+        carried = None
+        while not stopping:
+            # Wait for at least one email, then take whatever else has built
+            # up in the meantime, as long as it fits in the batch. An email
+            # that doesn't fit is carried over to the next batch, and one
+            # that's too big for any batch is sent on its own.
+            batch = []
+            batch_bytes = 0
+            while True:
+                if carried is not None:
+                    entry, carried = carried, None
+                else:
+                    item = self.queue.get()
+                    if item is None:
+                        stopping = True
+                        break
+                    email, on_sent = item
+                    try:
+                        entry = (email, on_sent, json.dumps(email).encode('utf-8'))
+                    except (TypeError, ValueError) as e:
+                        print('Cannot send email to %s: %s' % (email.get('To'), e), file=sys.stderr)
+                        self.num_failed += 1
+                        if batch and self.queue.empty():
+                            break
+                        continue
+
+                if batch and batch_bytes + len(entry[2]) > self.max_batch_bytes:
+                    carried = entry
+                    break
+
+                batch.append(entry)
+                batch_bytes += len(entry[2])
+                if len(batch) >= self.max_batch_size or self.queue.empty():
+                    break
+
+            if batch:
+                try:
+                    self.send_batch(batch)
+                except Exception as e:
+                    print('Failed to send %s email(s): %r' % (len(batch), e), file=sys.stderr)
+                    self.num_failed += len(batch)
+
+    def send_batch(self, batch):
+        """
+        Send a list of (email, on_sent, encoded email) in one request.
+        """
+        requests = get_requests()
+        if len(batch) == 1:
+            url, data = self.api_root + '/email', batch[0][2]
+        else:
+            url, data = self.api_root + '/email/batch', b'[' + b','.join(encoded for _, _, encoded in batch) + b']'
+
+        retry_timeout = 1
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(url, data=data, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                response = None
+                print('Failed to send %s email(s) (%s)' % (len(batch), e), file=sys.stderr, end='')
+            else:
+                # Retry server errors, and being asked to slow down
+                if response.status_code < 500 and response.status_code != 429:
+                    break
+                print('Received a %s response sending %s email(s)' % (response.status_code, len(batch)), file=sys.stderr, end='')
+
+            if attempt < self.max_retries:
+                print('; sleeping for %s seconds' % (retry_timeout,), file=sys.stderr)
+                time.sleep(retry_timeout)
+                if retry_timeout < 30:
+                    retry_timeout *= 2
+            else:
+                print('; giving up.', file=sys.stderr)
+
+        self.check_response(batch, response)
+
+    def check_response(self, batch, response):
+        if response is None:
+            self.num_failed += len(batch)
+            return
+
+        if response.status_code != 200:
+            print('Received a non-success response (%s): %s' % (response.status_code, response.content), file=sys.stderr)
+            self.num_failed += len(batch)
+            return
+
+        # A batch response has a result for each of the emails in the batch.
+        if len(batch) > 1:
+            try:
+                results = response.json()
+            except ValueError:
+                print('Received an unreadable response to a batch of %s email(s): %s' % (len(batch), response.content), file=sys.stderr)
+                self.num_failed += len(batch)
+                return
+        else:
+            results = [{'ErrorCode': 0}]
+
+        for (email, on_sent, _), result in zip(batch, results):
+            if result.get('ErrorCode', 0) != 0:
+                print('Failed to send email to %s (%s): %s' % (email.get('To'), result.get('ErrorCode'), result.get('Message')), file=sys.stderr)
+                self.num_failed += 1
+                continue
+
+            self.num_sent += 1
+            if on_sent is not None:
+                # A failed callback (e.g. saving a report's state) shouldn't
+                # stop the rest of the emails from being sent.
+                try:
+                    on_sent()
+                except Exception as e:
+                    print('Error after sending email to %s: %r' % (email.get('To'), e), file=sys.stderr)
+
+
+class EmailOutbox (object):
+    """
+    Holds on to emails instead of sending them, e.g. for a worker process to
+    hand its emails back to the process with the real sender.
+    """
+    def __init__(self):
+        self.emails = []
+
+    def send(self, email, on_sent=None):
+        self.emails.append((email, on_sent))
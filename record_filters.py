@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""
+A small language for filtering places and other records, compiled once into a
+single predicate function.
+
+A filter is a list of clauses, all of which a record has to match. Each clause
+is one of:
+
+    PATH=VALUE, PATH!=VALUE     The value at PATH is (or isn't) VALUE
+    PATH<VALUE, PATH<=VALUE,
+    PATH>VALUE, PATH>=VALUE     The value at PATH is before/after VALUE
+    PATH exists                 The record has a value at PATH
+    PATH missing                The record has no value at PATH
+
+PATH is a dotted path into the record, like "properties.source" or
+"submitter.name"; list items are reached by their index. If the first segment
+of a path isn't in the record, it's looked up in the record's properties, so
+"source" works for places as well as "properties.source".
+
+VALUE is typed by what it looks like: numbers (12, 3.5) and true/false/null
+compare as such, ISO8601 dates and date/times (2016-01-01, or
+2016-01-01T12:00:00-05:00) compare as moments in time (in UTC unless they
+have an offset), and anything else compares as a string. The record's value is
+converted to the same type before it's compared, and a value that can't be
+converted doesn't match. A VALUE in quotes ("01234" or '01234') is always a
+string, and only matches record values that are exactly that string. A missing
+value counts as null for = and !=, and never matches the ordering comparisons.
+An unquoted VALUE that looks like a date but isn't a valid one (2016-02-30) is
+an error.
+
+For example, to match the places imported in a batch during January 2016:
+
+    source=import-2016 created_datetime>=2016-01-01 created_datetime<2016-02-01
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+import datetime
+import json
+import operator
+import re
+
+try:
+    # Python 2
+    str_base = basestring
+except NameError:
+    # Python 3
+    str_base = str
+
+
+MISSING = object()
+
+comparison_pattern = re.compile(r'^\s*(?P<path>[^\s=!<>]+)\s*(?P<op>!=|<=|>=|=|<|>)\s*(?P<value>.*?)\s*$')
+existence_pattern = re.compile(r'^\s*(?P<path>[^\s=!<>]+)\s+(?P<op>exists|missing)\s*$')
+datetime_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}:?\d{2})?$')
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class FilterError (ValueError):
+    pass
+
+
+def compile_path(path):
+    """
+    Make a function that gets the value at a dotted path in a record, or
+    MISSING if there's nothing there.
+    """
+    segments = path.split('.')
+
+    def get_value(record):
+        value = _resolve(record, segments)
+        if value is MISSING:
+            properties = _resolve(record, ['properties'])
+            if properties is not MISSING:
+                value = _resolve(properties, segments)
+        return value
+    return get_value
+
+
+def _resolve(value, segments):
+    for segment in segments:
+        try:
+            if isinstance(value, (list, tuple)):
+                value = value[int(segment)]
+            else:
+                value = value[segment]
+        except (KeyError, IndexError, TypeError, ValueError):
+            return MISSING
+    return value
+
+
+def parse_datetime(value):
+    from dateutil import parser
+    import pytz
+
+    dt = parser.parse(value)
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    return dt
+
+
+def parse_literal(text):
+    """
+    Get the typed value of a literal in a filter, along with a function that
+    converts record values to the same type (returning MISSING if they can't
+    be).
+    """
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in '"\'':
+        if text[0] == '"':
+            try:
+                return json.loads(text), to_exact_string
+            except ValueError:
+                pass
+        return text[1:-1], to_exact_string
+    if text in ('true', 'false', 'null'):
+        return json.loads(text), to_json_constant
+    try:
+        number = json.loads(text)
+    except ValueError:
+        pass
+    else:
+        if isinstance(number, (int, float)) and not isinstance(number, bool):
+            return number, to_number
+    if datetime_pattern.match(text):
+        try:
+            return parse_datetime(text), to_datetime
+        except (ValueError, OverflowError):
+            raise FilterError('%r looks like a date, but is not a valid one. Put it in quotes to compare it as a string.' % (text,))
+    return text, to_string
+
+
+def to_json_constant(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, str_base) and value in ('true', 'false', 'null'):
+        return json.loads(value)
+    return MISSING
+
+
+def to_number(value):
+    if isinstance(value, bool):
+        return MISSING
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return MISSING
+
+
+def to_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value if value.tzinfo else parse_datetime(value.isoformat())
+    if isinstance(value, str_base):
+        try:
+            return parse_datetime(value)
+        except (ValueError, OverflowError):
+            pass
+    return MISSING
+
+
+def quote_literal(value):
+    """
+    Quote a string for use as a VALUE in a filter, so that it's compared as
+    that exact string.
+    """
+    return json.dumps(value)
+
+
+def to_exact_string(value):
+    return value if isinstance(value, str_base) else MISSING
+
+
+def to_string(value):
+    if isinstance(value, str_base):
+        return value
+    if value is None or isinstance(value, (dict, list, tuple)):
+        return MISSING
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return '%s' % (value,)
+
+
+def compile_clause(clause):
+    """
+    Compile a single clause into a predicate function.
+    """
+    match = existence_pattern.match(clause)
+    if match:
+        get_value = compile_path(match.group('path'))
+        if match.group('op') == 'exists':
+            return lambda record: get_value(record) is not MISSING
+        else:
+            return lambda record: get_value(record) is MISSING
+
+    match = comparison_pattern.match(clause)
+    if not match:
+        raise FilterError('I do not understand the filter %r. Filters look like "path=value", "path>=value" or "path exists".' % (clause,))
+
+    get_value = compile_path(match.group('path'))
+    op = match.group('op')
+    compare = OPERATORS[op]
+    literal, convert = parse_literal(match.group('value'))
+    if literal is None and op not in ('=', '!='):
+        raise FilterError('Only = and != can be used with null, in %r.' % (clause,))
+
+    if op in ('=', '!='):
+        def matches(record):
+            value = get_value(record)
+            if value is MISSING or value is None:
+                return compare(None, literal)
+            value = convert(value)
+            if value is MISSING:
+                return op == '!='
+            return compare(value, literal)
+    else:
+        def matches(record):
+            value = get_value(record)
+            if value is MISSING or value is None:
+                return False
+            value = convert(value)
+            if value is MISSING:
+                return False
+            try:
+                return compare(value, literal)
+            except TypeError:
+                return False
+    return matches
+
+
+def compile_filter(clauses):
+    """
+    Compile a list of clauses into one predicate function that is True for the
+    records that match all of them.
+    """
+    predicates = [compile_clause(clause) for clause in clauses]
+
+    if not predicates:
+        return lambda record: True
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def matches_all(record):
+        for predicate in predicates:
+            if not predicate(record):
+                return False
+        return True
+    return matches_all
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""
+State that a report keeps from one run to the next, such as the latest
+created/updated date/time it has already processed (its watermark) and the
+totals it last reported. The state is stored as a JSON file per report.
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+import json
+import os
+import re
+import sys
+
+
+class ReportState (object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = {}
+
+        if os.path.exists(filename):
+            with open(filename) as state_file:
+                self.data = json.load(state_file)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def save(self):
+        # Write to a temporary file first, so that a failed run can't leave a
+        # half-written state behind.
+        state_dir = os.path.dirname(self.filename)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as state_file:
+            json.dump(self.data, state_file, indent=2, sort_keys=True)
+        os.rename(temp_filename, self.filename)
+        print('Saved state to %s' % (self.filename,), file=sys.stderr)
+
+
+class StateUpdate (object):
+    """
+    Values to save to a report's state later, e.g. once its email has been
+    delivered. Calling it saves them. It can be pickled, so that worker
+    processes can hand it back along with their emails.
+    """
+    def __init__(self, filename, values):
+        self.filename = filename
+        self.values = values
+
+    def __call__(self):
+        state = ReportState(self.filename)
+        for key, value in self.values.items():
+            state.set(key, value)
+        state.save()
+
+
+def get_state_filename(report, report_filename=None, state_dir=None, suffix='.state.json'):
+    """
+    Get the name of the state file for a report: the report's own state_file
+    setting, or a file named after the report (with the given suffix in place
+    of its extension) in the state directory. Returns None if the report has
+    no state file.
+
+    Each tool uses its own suffix, so that they don't share a state file, and
+    so that the state can never take the place of the report's own file.
+    """
+    if report.get('state_file'):
+        return report['state_file']
+    if state_dir and report_filename:
+        report_name = os.path.splitext(os.path.basename(report_filename))[0]
+        return os.path.join(state_dir, report_name + suffix)
+    return None
+
+
+def get_record_time(record, field):
+    """
+    Get a date/time field from a record, which may be a submission or a place
+    (with the field in its properties).
+    """
+    try:
+        return record[field]
+    except KeyError:
+        return record.get('properties', {}).get(field)
+
+
+# A date/time that's already in UTC, in the form the API writes them.
+UTC_TIME_PATTERN = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d*)?(?:Z|\+00:00)$')
+
+
+def utc_sort_key(value):
+    """
+    Get a string for an ISO8601 date/time that sorts the same way as the
+    moment it represents, by expressing it in UTC without an offset. Values
+    from the API are already in UTC, so most only need their offset dropped.
+    """
+    if not value:
+        return ''
+    match = UTC_TIME_PATTERN.match(value)
+    if match:
+        seconds, fraction = match.groups()
+        return seconds + format_fraction(fraction[1:7] if fraction else '')
+
+    from dateutil import parser
+    import pytz
+    try:
+        dt = parser.parse(value)
+    except (TypeError, ValueError, OverflowError):
+        return value
+    if dt.tzinfo:
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    return format_utc_sort_key(dt)
+
+
+def format_utc_sort_key(dt):
+    key = '%04d-%02d-%02dT%02d:%02d:%02d' % (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+    return key + format_fraction('%06d' % dt.microsecond)
+
+
+def format_fraction(digits):
+    # Leave off any trailing zeros in the fraction of a second (and the point,
+    # if that's all there is), so that equal moments written with different
+    # precisions compare equal.
+    digits = digits.rstrip('0')
+    return '.' + digits if digits else ''
+
+
+def get_record_sort_keys(record):
+    """
+    Get a record's created date/time and the later of its created and updated
+    date/times, as UTC sort keys (see utc_sort_key).
+    """
+    created = utc_sort_key(get_record_time(record, 'created_datetime'))
+    return created, max(created, utc_sort_key(get_record_time(record, 'updated_datetime')))
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""
+Profile the fields of a set of records (places or submissions) in a single
+pass: the type of each field's values, how often it's empty, roughly how many
+distinct values it has, and a few examples.
+
+The distinct counts are estimated with a K-Minimum-Values sketch, so a field
+takes a bounded amount of memory no matter how many records are profiled;
+they're exact for fields with fewer distinct values than the sketch holds.
+Records can also be sampled, in which case the counts and rates are for the
+sample.
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+import hashlib
+import heapq
+import json
+import random
+import re
+
+try:
+    # Python 2
+    str_base = basestring
+except NameError:
+    # Python 3
+    str_base = str
+
+
+datetime_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}:?\d{2})?$')
+
+HASH_SPACE = float(2 ** 64)
+
+
+def get_type_name(value):
+    if value is None or value == '':
+        return 'null'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str_base):
+        return 'datetime' if datetime_pattern.match(value) else 'string'
+    if isinstance(value, (list, tuple)):
+        return 'list'
+    if isinstance(value, dict):
+        return 'object'
+    # Python 2 longs, and anything else
+    return type(value).__name__
+
+
+class DistinctSketch (object):
+    """
+    Estimates the number of distinct values added to it by keeping the k
+    smallest of their hashes (a K-Minimum-Values sketch).
+    """
+    def __init__(self, k=1024):
+        self.k = k
+        self.heap = []      # The negated k smallest hashes, as a max-heap
+        self.hashes = set()
+
+    def add(self, value):
+        if not isinstance(value, str_base):
+            value = json.dumps(value, sort_keys=True)
+        value_hash = int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+        if value_hash in self.hashes:
+            return
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, -value_hash)
+            self.hashes.add(value_hash)
+        elif value_hash < -self.heap[0]:
+            removed = -heapq.heappushpop(self.heap, -value_hash)
+            self.hashes.discard(removed)
+            self.hashes.add(value_hash)
+
+    def estimate(self):
+        if len(self.heap) < self.k:
+            return len(self.heap)
+        kth_smallest = -self.heap[0] / HASH_SPACE
+        return int(round((self.k - 1) / kth_smallest))
+
+    @property
+    def exact(self):
+        return len(self.heap) < self.k
+
+
+class FieldProfile (object):
+    def __init__(self, sketch_size=1024, max_examples=5):
+        self.num_values = 0
+        self.type_counts = {}
+        self.distinct = DistinctSketch(sketch_size)
+        self.examples = []
+        self.max_examples = max_examples
+
+    def add(self, value):
+        type_name = get_type_name(value)
+        self.type_counts[type_name] = self.type_counts.get(type_name, 0) + 1
+        if type_name == 'null':
+            return
+
+        self.num_values += 1
+        self.distinct.add(value)
+        if len(self.examples) < self.max_examples and value not in self.examples:
+            self.examples.append(value)
+
+    def get_type(self):
+        """
+        The name of the field's type, or of each of its types (most common
+        first, with the share of the values that have it) if it has several.
+        """
+        type_counts = dict((name, count) for name, count in self.type_counts.items() if name != 'null')
+        if not type_counts:
+            return 'null'
+        if len(type_counts) == 1:
+            return list(type_counts)[0]
+
+        total = sum(type_counts.values())
+        return ', '.join('%s (%d%%)' % (name, round(100.0 * count / total))
+                         for name, count in sorted(type_counts.items(), key=lambda pair: (-pair[1], pair[0])))
+
+
+class SchemaProfiler (object):
+    """
+    Profiles the fields of the records added to it. Nested objects are
+    profiled field by field, with dotted names (e.g. "submitter.name"), down
+    to max_depth levels. If sample_rate is less than 1, only about that share
+    of the records is profiled.
+    """
+    def __init__(self, sample_rate=1.0, sketch_size=1024, max_examples=5, max_depth=2, seed=None):
+        self.sample_rate = sample_rate
+        self.sketch_size = sketch_size
+        self.max_examples = max_examples
+        self.max_depth = max_depth
+        self.random = random.Random(seed)
+
+        self.num_seen = 0
+        self.num_profiled = 0
+        self.fields = {}
+
+    def add(self, record):
+        self.num_seen += 1
+        if self.sample_rate < 1 and self.random.random() >= self.sample_rate:
+            return
+
+        self.num_profiled += 1
+        self._add_fields(record, '', 1)
+
+    def add_all(self, records):
+        for record in records:
+            self.add(record)
+        return self
+
+    def _add_fields(self, record, prefix, depth):
+        for key, value in record.items():
+            name = prefix + key
+            if isinstance(value, dict) and value and depth < self.max_depth:
+                self._add_fields(value, name + '.', depth + 1)
+                continue
+
+            if name not in self.fields:
+                self.fields[name] = FieldProfile(self.sketch_size, self.max_examples)
+            self.fields[name].add(value)
+
+    def get_profile(self):
+        """
+        Get a dict with the profile of each field: its type, its null rate
+        (the share of the profiled records in which it's missing or empty),
+        its approximate number of distinct values, and some example values.
+        """
+        profile = {}
+        for name, field in self.fields.items():
+            profile[name] = {
+                'type': field.get_type(),
+                'null_rate': (1 - field.num_values / self.num_profiled) if self.num_profiled else 0,
+                'distinct': field.distinct.estimate(),
+                'distinct_is_exact': field.distinct.exact,
+                'examples': field.examples,
+            }
+        return profile
+
+
+def format_example(value, max_len=40):
+    if not isinstance(value, str_base):
+        value = json.dumps(value, sort_keys=True)
+    value = value.replace('\n', ' ')
+    return value if len(value) <= max_len else value[:max_len - 3] + '...'
+
+
+def print_profile(title, profiler, outfile):
+    if profiler.sample_rate < 1:
+        print('%s (%s of %s records sampled):' % (title, profiler.num_profiled, profiler.num_seen), file=outfile)
+    else:
+        print('%s (%s records):' % (title, profiler.num_seen), file=outfile)
+
+    profile = profiler.get_profile()
+    for name in sorted(profile):
+        field = profile[name]
+        print('  - %s' % (name,), file=outfile)
+        print('      type: %s' % (field['type'],), file=outfile)
+        print('      null: %.1f%%' % (100.0 * field['null_rate'],), file=outfile)
+        print('      distinct: %s%s' % ('' if field['distinct_is_exact'] else '~', field['distinct']), file=outfile)
+        if field['examples']:
+            print('      examples: %s' % (', '.join(format_example(example) for example in field['examples']),), file=outfile)
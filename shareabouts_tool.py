@@ -3,12 +3,10 @@ from __future__ import print_function, unicode_literals, division
 import csv
 import json
 import math
-import pytz
-import requests
 import sys
 import threading
 import time
-from shareabouts import ShareaboutsApi
+
 
 try:
     cli_input = raw_input
@@ -21,6 +19,21 @@ except NameError:
     str_base = str
 
 
+# The API client and requests are imported when they're first used, so that
+# the command line tools start quickly.
+_requests = None
+
+def get_requests():
+    """
+    Get the requests module, importing it the first time it's needed.
+    """
+    global _requests
+    if _requests is None:
+        import requests
+        _requests = requests
+    return _requests
+
+
 def chunks_of(iterable, max_len):
     """
     Split the iterable into chunks (tuples) of no more than max_len length.
@@ -49,6 +62,51 @@ def chunks_of(iterable, max_len):
         yield chunk
 
 
+SNAPSHOT_CHUNK_SIZE = 64 * 1024
+
+
+def iter_csv_lines(chunks):
+    """
+    Split an iterable of byte chunks into lines, keeping their line endings,
+    in the form the csv module reads them: bytes in Python 2, and text in
+    Python 3. Since a newline byte is never part of a multi-byte UTF-8
+    character, each line can be decoded on its own.
+    """
+    decode = (bytes is not str)
+    leftover = b''
+    for chunk in chunks:
+        lines = (leftover + chunk).splitlines(True)
+        leftover = b''
+        if lines and not lines[-1].endswith((b'\n', b'\r')):
+            leftover = lines.pop()
+        # A \r at the end of a chunk may be the first half of a \r\n.
+        if lines and lines[-1].endswith(b'\r'):
+            leftover = lines.pop() + leftover
+        for line in lines:
+            yield line.decode('utf-8') if decode else line
+    if leftover:
+        yield leftover.decode('utf-8') if decode else leftover
+
+
+def convert_time_string(value, timezone):
+    """
+    Convert a date/time string with an offset to the given timezone. Any
+    other string is returned as is.
+    """
+    from dateutil import parser
+
+    try:
+        dt = parser.parse(value)
+    except (TypeError, ValueError):
+        return value
+    except OverflowError:  # <-- a phone number with no dashes was causing an overflow error???
+        return value
+    if dt.tzinfo:
+        dt = dt.astimezone(timezone)
+        value = dt.isoformat()
+    return value
+
+
 class ShareaboutsTool (object):
     def __init__(self, host, auth=None):
         self.api_root = host + '/api/v2/'
@@ -56,7 +114,9 @@ class ShareaboutsTool (object):
         self.submissions_url_template = self.api_root + '%s/datasets/%s/submissions'
         self.snapshots_url_template = self.api_root + '%s/datasets/%s/%s/snapshots'
 
+        from shareabouts import ShareaboutsApi
         self.api = ShareaboutsApi(self.api_root)
+        self.auth = auth
         if auth:
             self.api.authenticate_with_basic(*auth)  # <-- (username, password)
             self.fetch_params = {
@@ -66,37 +126,34 @@ class ShareaboutsTool (object):
         else:
             self.fetch_params = {}
 
-    def convert_times(self, data, timezone):
+    def convert_times(self, data, timezone, fields=None):
+        """
+        Convert the date/time strings in the data to the given timezone, in
+        place. If a collection of field names is given, only strings stored
+        under those keys are converted.
+        """
         from shareabouts.models import ShareaboutsModel, ShareaboutsCollection
-        from dateutil import parser
 
         if isinstance(data, (list, ShareaboutsCollection)):
             for elem in data:
-                self.convert_times(elem, timezone)
+                self.convert_times(elem, timezone, fields)
             return data
 
         elif isinstance(data, (dict, ShareaboutsModel)):
             for key in data:
                 value = data[key]
-                data[key] = self.convert_times(value, timezone)
+                if fields is not None and isinstance(value, str_base) and key not in fields:
+                    continue
+                data[key] = self.convert_times(value, timezone, fields)
             return data
 
         elif isinstance(data, str_base):
-            try:
-                dt = parser.parse(data)
-            except (TypeError, ValueError):
-                return data
-            except OverflowError:  # <-- a phone number with no dashes was causing an overflow error???
-                return data
-            if dt.tzinfo:
-                dt = dt.astimezone(timezone)
-                data = dt.isoformat()
-            return data
+            return convert_time_string(data, timezone)
 
         else:
             return data
 
-    def get_places(self, owner, dataset):
+    def get_places(self, owner, dataset, compact=False):
         places_url = self.places_url_template % (owner, dataset)
 
         # Load all of the dataset's places into memory, mapped by their ids
@@ -110,9 +167,71 @@ class ShareaboutsTool (object):
             print('\r...loaded page %s of %s  ' % (num_loaded_pages, places.page_count), end='', file=sys.stderr)
         print(file=sys.stderr)
 
+        if compact:
+            from compact import Compactor
+            compactor = Compactor()
+            return [compactor.compact_place(place.serialize()) for place in places]
         return list(places)
 
-    def get_snapshot(self, owner, dataset, set_name='places', format='json', force_new=False, params=None):
+    def iter_pages(self, url, params=None):
+        """
+        Fetch one of the API's lists a page at a time, following each page's
+        link to the next. Yields the records on each page (the features of a
+        page of places, or the results of a page of submissions), so that the
+        list can be gone through without holding all of it in memory.
+        """
+        requests = get_requests()
+        if params is None: params = self.fetch_params
+        num_loaded_pages = 0
+
+        while url:
+            response = requests.get(url, params=params, auth=self.auth)
+            if response.status_code != 200:
+                raise Exception('Unexpected response from %s: %s, %s' % (url, response.status_code, response.content))
+
+            try:
+                page = response.json()
+            except ValueError:
+                raise Exception('Unexpected non-JSON content from %s: %s' % (url, response.content))
+
+            metadata = page.get('metadata', {})
+            num_loaded_pages += 1
+            print('\r...loaded page %s of %s  ' % (num_loaded_pages, metadata.get('num_pages', '?')), end='', file=sys.stderr)
+            yield page.get('features', page.get('results', []))
+
+            # The next page's URL already has the query parameters in it.
+            url, params = metadata.get('next'), None
+        print(file=sys.stderr)
+
+    def iter_submission_set_urls(self, owner, dataset, set_names=None):
+        """
+        Yield the name and URL of each of a dataset's submission sets (or of
+        only the named ones).
+        """
+        dataset = self.api.account(owner).dataset(dataset)
+        dataset.fetch()
+
+        for set_name in dataset.get('submission_sets'):
+            if set_names is not None and set_name not in set_names:
+                print('Skipping submissions in %s.' % (set_name,), file=sys.stderr)
+                continue
+            yield set_name, dataset.submissions.in_set(set_name).url()
+
+    def get_snapshot(self, owner, dataset, set_name='places', format='json', force_new=False, params=None, stream=False):
+        """
+        Download a snapshot of one of a dataset's sets, waiting for it to be
+        built if necessary. Returns the snapshot's content, or, if stream is
+        True, an iterator over its content in chunks of bytes.
+        """
+        snapshot_url = self.request_snapshot(owner, dataset, set_name, force_new=force_new, params=params)
+        return self.wait_for_snapshot(owner, dataset, set_name, snapshot_url, format=format, stream=stream)
+
+    def request_snapshot(self, owner, dataset, set_name='places', force_new=False, params=None):
+        """
+        Find the latest snapshot of one of a dataset's sets, or ask for a new
+        one to be built. Returns the snapshot's URL, without waiting for it to
+        be ready.
+        """
         snapshots_url = (self.snapshots_url_template % (owner, dataset, set_name))
         if params is None: params = self.fetch_params
         send_data = params.copy()
@@ -162,13 +281,22 @@ class ShareaboutsTool (object):
             except KeyError:
                 raise Exception('Unexpected JSON content from new %s snapshot request for dataset %s/%s (no URL): %s' % (set_name, owner, dataset, response.content))
 
+        return snapshot_url
+
+    def wait_for_snapshot(self, owner, dataset, set_name, snapshot_url, format='json', stream=False):
+        """
+        Download a snapshot from the URL given by request_snapshot, polling
+        until it's ready.
+        """
+        snapshots_url = (self.snapshots_url_template % (owner, dataset, set_name))
         snapshot_url += '.' + format
         first_check = True
         while True:
             # Forever, try to download the snapshot.
-            response = requests.get(snapshot_url)
+            response = get_requests().get(snapshot_url, stream=stream)
 
             if response.status_code == 503:
+                response.close()
                 if first_check:
                     print('Waiting for %s snapshot from %s...' % (set_name, snapshots_url,), file=sys.stderr, end='')
                     first_check = False
@@ -178,34 +306,52 @@ class ShareaboutsTool (object):
 
             elif response.status_code == 200:
                 if not first_check: print('', file=sys.stderr)
+                if stream:
+                    return response.iter_content(chunk_size=SNAPSHOT_CHUNK_SIZE)
                 return response.content
 
             else:
                 raise Exception('Unexpected response from %s snapshot for dataset %s/%s: %s, %s' % (set_name, owner, dataset, response.status_code, response.content))
 
-    def get_submissions(self, owner, dataset):
+    def get_submissions(self, owner, dataset, set_names=None, compact=False):
+        all_submissions = []
+        for set_name, submissions in self.iter_submission_sets(owner, dataset, set_names, compact):
+            all_submissions.extend(submissions)
+        return all_submissions
+
+    def iter_submission_sets(self, owner, dataset, set_names=None, compact=False):
+        """
+        Load a dataset's submissions one set at a time. Yields the name of
+        each set along with its submissions (as compact records, if compact
+        is True; see compact.py).
+        """
         dataset = self.api.account(owner).dataset(dataset)
         dataset.fetch()
 
-        all_submissions = []
+        if compact:
+            from compact import Compactor
+            compactor = Compactor()
 
         for set_name in dataset.get('submission_sets'):
+            if set_names is not None and set_name not in set_names:
+                print('Skipping submissions in %s.' % (set_name,), file=sys.stderr)
+                continue
+
             submissions = dataset.submissions.in_set(set_name)
 
-            # Load all of the dataset's places into memory, mapped by their ids
+            # Load all of the set's submissions into memory
             print('Loading submissions from %s...' % submissions.url(), file=sys.stderr)
             num_loaded_pages = 0
 
-            submissions = dataset.submissions.in_set(set_name)
-
             for page in submissions.fetch_all(**self.fetch_params):
                 num_loaded_pages += 1
                 print('\r...loaded page %s of %s  ' % (num_loaded_pages, submissions.page_count), end='', file=sys.stderr)
             print(file=sys.stderr)
 
-            all_submissions.extend(submissions)
-
-        return all_submissions
+            if compact:
+                yield set_name, [compactor.compact(submission.serialize()) for submission in submissions]
+            else:
+                yield set_name, list(submissions)
 
     def get_source_place_map(self, all_places, mapped_id_field='_imported_id'):
         mapped_places = {}
@@ -214,9 +360,11 @@ class ShareaboutsTool (object):
             # If a place has a field that matches the id_field_name, assume
             # that it corresponds to the ID of the place from the imported
             # data.
+            # The source IDs are mapped as strings, since the server may have
+            # them as numbers while the source file has them as strings.
             if mapped_id_field in place:
                 source_id = place[mapped_id_field]
-                mapped_places[source_id] = place
+                mapped_places['%s' % (source_id,)] = place
 
         print('\nSaw %s places, with %s having come from somewhere else.' % (len(all_places), len(mapped_places)), file=sys.stderr)
         return mapped_places
@@ -258,8 +406,9 @@ class ShareaboutsTool (object):
                             del place['properties'][field]
 
                 # Use the source ID to match any existing data, if it exists
-                if feature_id in mapped_places:
-                    old_place = mapped_places[feature_id]
+                # (The manifest keeps source IDs as strings.)
+                old_place = mapped_places.get(feature_id, mapped_places.get('%s' % (feature_id,)))
+                if old_place is not None:
                     if 'id' in old_place:
                         place['id'] = old_place['id']
                     else:
@@ -289,7 +438,7 @@ class ShareaboutsTool (object):
 
         # CSVs only know about strings, so make sure places are mapped by
         # strings.
-        for map_key in mapped_places.keys():
+        for map_key in list(mapped_places.keys()):
             mapped_places[str(map_key)] = mapped_places.pop(map_key)
 
         # Load the new places from the file
@@ -318,12 +467,20 @@ class ShareaboutsTool (object):
                     'type': 'Feature'
                 }
 
-                # Special case for lat/lng
+                # Special case for lat/lng. Rows with empty or unreadable
+                # coordinates are loaded anyway (with no geometry, or with
+                # the coordinates as they are), for validation to reject.
                 if 'lat' in properties and 'lon' in properties:
-                    place['geometry'] = {
-                        'type': 'Point',
-                        'coordinates': [float(properties.pop('lon')), float(properties.pop('lat'))]
-                    }
+                    lon, lat = properties.pop('lon').strip(), properties.pop('lat').strip()
+                    if lon or lat:
+                        try:
+                            coordinates = [float(lon), float(lat)]
+                        except ValueError:
+                            coordinates = [lon, lat]
+                        place['geometry'] = {
+                            'type': 'Point',
+                            'coordinates': coordinates
+                        }
 
                 # Keep only fields we want
                 if include_fields:
@@ -355,6 +512,29 @@ class ShareaboutsTool (object):
         print('%s place(s) loaded, with %s having been seen before.' % (len(loaded_places), len([place for place in loaded_places if 'url' in place['properties']])), file=sys.stderr)
         return loaded_places
 
+    def with_existing_places(self, loaded_places, mapped_places, mapped_id_field='_imported_id'):
+        """
+        Match places loaded from a source (with no existing places) up with
+        the existing places that came from the same source, the same way that
+        updated_from_geojson and updated_from_csv do. Returns copies of the
+        loaded places, so the same loaded places can be matched against more
+        than one dataset.
+        """
+        matched_places = []
+        for loaded_place in loaded_places:
+            place = loaded_place.copy()
+            place['properties'] = loaded_place['properties'].copy()
+
+            source_id = place['properties'].get(mapped_id_field)
+            old_place = mapped_places.get('%s' % (source_id,))
+            if old_place is not None:
+                if 'id' in old_place:
+                    place['id'] = old_place['id']
+                place['properties']['url'] = old_place['url']
+
+            matched_places.append(place)
+        return matched_places
+
     def save_places(self, owner, dataset, dataset_key, loaded_places, callback, silent=True, create=True, update=True, partial=True):
         # Upload the places, with PATCH/PUT if they have a URL, otherwise with POST
         places_url = self.places_url_template % (owner, dataset)
@@ -388,9 +568,21 @@ class ShareaboutsTool (object):
                 thread.join()
 
 
-class UploadPlaceThread (threading.Thread):
-    finite_threads = threading.BoundedSemaphore(value=4)
+# The saves and deletes in the process all share one limit on the number of
+# them that may be sent at a time.
+connection_slots = threading.BoundedSemaphore(value=4)
+
+def set_max_connections(max_connections):
+    """
+    Set the most places that may be saved or deleted at a time. The limit is
+    shared by every upload (and delete) in the process. Set it before any
+    places are sent.
+    """
+    global connection_slots
+    connection_slots = threading.BoundedSemaphore(value=max_connections)
 
+
+class UploadPlaceThread (threading.Thread):
     def __init__(self, place, places_url, dataset_key, callback, silent=True, create=True, update=True, partial=True):
         self.place = place
         self.places_url = places_url
@@ -405,7 +597,7 @@ class UploadPlaceThread (threading.Thread):
         super(UploadPlaceThread, self).__init__()
 
     def create_place(self):
-        return requests.post(
+        return get_requests().post(
             self.places_url,
             data=json.dumps(self.place),
             headers={
@@ -419,6 +611,7 @@ class UploadPlaceThread (threading.Thread):
 
     def update_place(self):
         place_url = self.place['properties']['url']
+        requests = get_requests()
         update_func = requests.patch if self.partial else requests.put
         return update_func(
             place_url,
@@ -433,8 +626,9 @@ class UploadPlaceThread (threading.Thread):
         )
 
     def run(self):
+        requests = get_requests()
         place = self.place
-        with UploadPlaceThread.finite_threads:
+        with connection_slots:
             retry_timeout = 1
 
             while True:
@@ -458,8 +652,6 @@ class UploadPlaceThread (threading.Thread):
 
 
 class DeletePlaceThread (threading.Thread):
-    finite_threads = threading.BoundedSemaphore(value=4)
-
     def __init__(self, place, dataset_key, callback):
         self.place = place
         self.dataset_key = dataset_key
@@ -468,12 +660,12 @@ class DeletePlaceThread (threading.Thread):
 
     def run(self):
         place = self.place
-        with DeletePlaceThread.finite_threads:
+        with connection_slots:
             # place.destroy()
 
             place_url = place.get('url')
             assert place_url is not None
-            place_response = requests.delete(
+            place_response = get_requests().delete(
                 place_url,
                 headers={
                     'content-type': 'application/json',
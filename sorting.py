@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sort keys shared by the report helpers and the command line tools.
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+
+def sort_key(value):
+    # Let values of mixed types (and None) be sorted together.
+    return (value is None, type(value).__name__, value if value is not None else '')
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""
+Assign places to the polygons they fall in (e.g. council districts or
+neighborhoods) from a boundary GeoJSON file, copying attributes of the polygon
+into the place's properties.
+
+The boundaries are put in a grid index by their bounding boxes, so that each
+point is only tested against the few polygons whose boxes cover its grid
+cell. Each polygon's edges are bucketed into horizontal bands, so that the
+point-in-polygon test only looks at the edges level with the point. Holes and
+multi-polygons are handled by counting crossings over all of a polygon's
+rings (the even-odd rule).
+
+Spatial joins are set in the upload config, and are applied to the places
+loaded from the source before they're checked and sent. Boundary features that
+aren't polygons or multi-polygons are skipped, with a warning.
+
+    "spatial_joins": [
+        {
+            "boundaries": "council_districts.geojson",
+            "fields": {"DISTRICT": "CounDist"},
+            "default_values": {"CounDist": "outside"}
+        }
+    ]
+
+"fields" maps the boundary properties to the place properties they're copied
+into, in the same way as "mapped_fields".
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+import json
+import math
+import sys
+
+
+class PreparedPolygon (object):
+    """
+    A Polygon or MultiPolygon geometry, set up for fast point-in-polygon
+    tests.
+    """
+    def __init__(self, geometry):
+        if geometry['type'] == 'Polygon':
+            rings = geometry['coordinates']
+        elif geometry['type'] == 'MultiPolygon':
+            rings = [ring for polygon in geometry['coordinates'] for ring in polygon]
+        else:
+            raise ValueError('Boundaries must be polygons or multi-polygons, not %s.' % (geometry['type'],))
+
+        edges = []
+        for ring in rings:
+            for start, end in zip(ring, ring[1:] + ring[:1]):
+                (x1, y1), (x2, y2) = start[:2], end[:2]
+                if y1 != y2:
+                    edges.append((x1, y1, x2, y2))
+
+        xs = [coord[0] for ring in rings for coord in ring]
+        ys = [coord[1] for ring in rings for coord in ring]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys)) if xs else (0, 0, 0, 0)
+
+        # Bucket the edges by the bands of latitude they span.
+        min_y, max_y = self.bbox[1], self.bbox[3]
+        self.num_bands = max(1, min(1024, len(edges) // 8))
+        self.band_height = ((max_y - min_y) / self.num_bands) or 1
+        self.bands = [[] for _ in range(self.num_bands)]
+        for edge in edges:
+            low, high = sorted((edge[1], edge[3]))
+            for band in range(self.get_band(low), self.get_band(high) + 1):
+                self.bands[band].append(edge)
+
+    def get_band(self, y):
+        band = int((y - self.bbox[1]) / self.band_height)
+        return min(max(band, 0), self.num_bands - 1)
+
+    def contains(self, x, y):
+        min_x, min_y, max_x, max_y = self.bbox
+        if not (min_x <= x <= max_x and min_y <= y <= max_y):
+            return False
+
+        inside = False
+        for x1, y1, x2, y2 in self.bands[self.get_band(y)]:
+            if (y1 > y) != (y2 > y):
+                if x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                    inside = not inside
+        return inside
+
+
+class GridIndex (object):
+    """
+    A uniform grid over the bounding boxes of a list of polygons. Each cell
+    lists the polygons whose bounding boxes overlap it.
+    """
+    def __init__(self, polygons, cells_per_polygon=4):
+        self.polygons = polygons
+        if not polygons:
+            self.bbox = (0, 0, 0, 0)
+            self.num_cols = self.num_rows = 1
+            self.cells = {}
+            return
+
+        self.bbox = (
+            min(polygon.bbox[0] for polygon in polygons),
+            min(polygon.bbox[1] for polygon in polygons),
+            max(polygon.bbox[2] for polygon in polygons),
+            max(polygon.bbox[3] for polygon in polygons))
+        width = (self.bbox[2] - self.bbox[0]) or 1
+        height = (self.bbox[3] - self.bbox[1]) or 1
+
+        # Make the cells roughly square.
+        num_cells = max(1, len(polygons) * cells_per_polygon)
+        self.num_cols = max(1, int(round(math.sqrt(num_cells * width / height))))
+        self.num_rows = max(1, int(round(num_cells / self.num_cols)))
+        self.cell_width = width / self.num_cols
+        self.cell_height = height / self.num_rows
+
+        self.cells = {}
+        for index, polygon in enumerate(polygons):
+            min_col, min_row = self.get_cell(polygon.bbox[0], polygon.bbox[1])
+            max_col, max_row = self.get_cell(polygon.bbox[2], polygon.bbox[3])
+            for col in range(min_col, max_col + 1):
+                for row in range(min_row, max_row + 1):
+                    self.cells.setdefault((col, row), []).append(index)
+
+    def get_cell(self, x, y):
+        col = int((x - self.bbox[0]) / self.cell_width)
+        row = int((y - self.bbox[1]) / self.cell_height)
+        return (min(max(col, 0), self.num_cols - 1),
+                min(max(row, 0), self.num_rows - 1))
+
+    def find(self, x, y):
+        """
+        Get the index of the first polygon that contains the point, or None.
+        """
+        min_x, min_y, max_x, max_y = self.bbox
+        if not (min_x <= x <= max_x and min_y <= y <= max_y):
+            return None
+
+        for index in self.cells.get(self.get_cell(x, y), ()):
+            if self.polygons[index].contains(x, y):
+                return index
+        return None
+
+
+def get_point(place):
+    """
+    Get the (x, y) of a place with a point geometry, or None.
+    """
+    geometry = place.get('geometry')
+    if not isinstance(geometry, dict) or geometry.get('type') != 'Point':
+        return None
+    try:
+        x, y = geometry['coordinates'][:2]
+        return float(x), float(y)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class SpatialJoin (object):
+    def __init__(self, boundaries_filename, fields, default_values={}):
+        self.boundaries_filename = boundaries_filename
+        self.fields = fields
+        self.default_values = default_values
+
+        with open(boundaries_filename) as boundaries_file:
+            features = json.load(boundaries_file)['features']
+
+        # Features that aren't polygons can't contain places, so they're left
+        # out (with a warning) instead of stopping the upload.
+        self.properties = []
+        polygons = []
+        for number, feature in enumerate(features, 1):
+            if not feature.get('geometry'):
+                continue
+            try:
+                polygons.append(PreparedPolygon(feature['geometry']))
+            except ValueError as e:
+                feature_name = 'feature %s' % (number,)
+                if feature.get('id') is not None:
+                    feature_name += ' (id %s)' % (feature['id'],)
+                print('Skipping %s in %s: %s' % (feature_name, boundaries_filename, e), file=sys.stderr)
+                continue
+            self.properties.append(feature.get('properties') or {})
+
+        self.index = GridIndex(polygons)
+
+    @classmethod
+    def from_config(cls, join_config):
+        return cls(join_config['boundaries'], join_config['fields'], join_config.get('default_values', {}))
+
+    def apply(self, places):
+        """
+        Copy the fields of the boundary that each place falls in into the
+        place's properties. Places outside of all of the boundaries get the
+        default values, if there are any. Only point places are joined.
+        """
+        num_joined = 0
+        for place in places:
+            point = get_point(place)
+            index = self.index.find(*point) if point is not None else None
+
+            properties = place['properties']
+            if index is not None:
+                num_joined += 1
+                boundary_properties = self.properties[index]
+                for boundary_field, place_field in self.fields.items():
+                    properties[place_field] = boundary_properties.get(boundary_field)
+            else:
+                for place_field, value in self.default_values.items():
+                    properties[place_field] = value
+
+        print('%s of %s place(s) fall within the boundaries in %s.' % (num_joined, len(places), self.boundaries_filename), file=sys.stderr)
+        return places
+
+
+def apply_spatial_joins(join_configs, places):
+    for join_config in join_configs:
+        SpatialJoin.from_config(join_config).apply(places)
+    return places
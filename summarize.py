@@ -5,14 +5,19 @@ from __future__ import print_function, unicode_literals, division
 
 from shareabouts_tool import ShareaboutsTool
 from argparse import ArgumentParser
+import copy
 import datetime
+import hashlib
 import json
 import os
-import pybars
-import pytz
+import re
+import shutil
 import sys
-from handlebars_utils import helpers
-import requests
+from handlebars_utils import helpers, clear_render_memo, memoized, compile_template, resolve, is_dictlike, split_place_args
+from mailer import PostmarkSender, EmailOutbox
+from report_state import ReportState, StateUpdate, get_state_filename, get_record_sort_keys, utc_sort_key
+from template_analysis import TemplateRequirements, analyze_template, analyze_template_file
+from compact import Compactor, json_default
 
 try:
     # Python 2
@@ -23,17 +28,14 @@ except NameError:
 
 
 UNDEFINED = object()
-dataset = None
+report_data = None
 
 
 # ============================================================================
 # Handlebars helpers very specific to Shareabouts report generation
 
 def get_place_data_for_url(url):
-    place_id = int(url.rsplit('/', 1)[-1])
-    place = dataset.places.get(place_id)
-    place_context = place.serialize() if place else None
-    return place_context
+    return report_data.get_place(url)
 
 def _with_place(this, options, url):
     """
@@ -90,93 +92,569 @@ def _annotate_with_places(this, options, context=UNDEFINED):
     if context is UNDEFINED:
         context = this
 
-    annotated_context = []
-    for submission in context:
-        annotated_submission = submission.copy() if submission is not None else None
-        annotated_submission['place'] = get_place_data_for_url(submission['place'])
-        annotated_context.append(annotated_submission)
-    return options['fn'](annotated_context)
+    # The annotated places are shared (read-only) from the report data, and
+    # annotating the same set again in the same render reuses the result.
+    def annotate_context():
+        annotated_context = []
+        for submission in context:
+            annotated_submission = submission.copy() if submission is not None else None
+            annotated_submission['place'] = get_place_data_for_url(submission['place'])
+            annotated_context.append(annotated_submission)
+        return annotated_context
+
+    return options['fn'](memoized('annotate_with_places', context, None, annotate_context))
 helpers['annotate_with_places'] = _annotate_with_places
 
+def _submissions_for_place(this, options, *args):
+    """
+    Select the submissions that belong to the given place (or the current
+    scope), optionally from only one submission set, and set them as the scope
+    within the block. The place may be given as a place or as its URL.
+
+    Usage: {{#submissions_for_place . "comments"}} {{length .}} {{/submissions_for_place}}
+           {{#submissions_for_place place}} {{length .}} {{/submissions_for_place}}
+    """
+    place, set_name = split_place_args(this, args)
+
+    if is_dictlike(place):
+        place = resolve(place, 'properties', 'url') or resolve(place, 'url')
+    submissions = report_data.get_place_submissions(place, set_name)
+
+    if len(submissions) == 0:
+        return options['inverse'](this)
+
+    return options['fn'](submissions)
+helpers['submissions_for_place'] = _submissions_for_place
+
+def _aggregate(this, options, *args):
+    """
+    Count the given collection (or the current scope) by one or more columns,
+    and set the list of counts ({values, count, percentage}, most frequent
+    first) as the scope within the block. Columns may be bucketed by date, and
+    submissions may be counted by attributes of their places.
+
+    Usage: {{#aggregate dataset.submission_sets.comments "place.properties.CounDist" "created_datetime:day"}}
+             {{#each .}} {{values.0}} {{values.1}}: {{count}} {{/each}}
+           {{/aggregate}}
+    """
+    if args and isinstance(args[0], str_type):
+        context, specs = this, args
+    else:
+        context, specs = args[0], args[1:]
+
+    from aggregate import count_records
+    counts = memoized(('aggregate',) + tuple(specs), context, None,
+        lambda: count_records(context, specs, joins={'place': report_data.get_place}))
+
+    if len(counts) == 0:
+        return options['inverse'](this)
+
+    return options['fn'](counts)
+helpers['aggregate'] = _aggregate
+
 
 
 # ============================================================================
 
 
-def main(config, reports):
-    if 'username' in config and 'password' in config:
-        auth_info = (config['username'], config['password'])
+def iter_chunks(rendered_template):
+    """
+    Iterate over the string chunks of a rendered template.
+    """
+    if isinstance(rendered_template, str_type):
+        yield rendered_template
     else:
-        auth_info = None
+        for chunk in rendered_template:
+            yield str_type(chunk)
 
-    # Download the data
-    tool = ShareaboutsTool(config['host'], auth=auth_info)
-    places = tool.get_places(config['owner'], config['dataset'])
-    submissions = tool.get_submissions(config['owner'], config['dataset'])
 
-    global dataset
-    dataset = tool.api.account(config['owner']).dataset(config['dataset'])
+class FrozenDict (dict):
+    """
+    A dict that can't be changed once it's built. Copies are regular dicts.
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Report data is shared between reports and cannot be changed.')
 
-    for report in reports:
-        status = generate_single_report(config, report, tool, dataset, places, submissions)
-        if status != 0: return status
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
 
+    def copy(self):
+        return dict(self)
 
-def generate_single_report(config, report, tool, dataset, places, submissions):
-    template_filename = report.get('summary_template')
-    assert template_filename, 'No template file specified'
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
 
-    # Compile the template
-    print ('Compiling and rendering the template(s): %s' % (report['summary_template'],), file=sys.stderr)
 
-    compiler = pybars.Compiler()
-    with open(report['summary_template'], 'rb') as template_file:
-        template_source = template_file.read().decode()
-        template = compiler.compile(template_source)
+def freeze(data):
+    """
+    Make a read-only copy of some serialized data, with dicts as FrozenDicts
+    and lists as tuples.
+    """
+    if isinstance(data, dict):
+        return FrozenDict((key, freeze(value)) for key, value in data.items())
+    elif isinstance(data, (list, tuple)):
+        return tuple(freeze(elem) for elem in data)
+    else:
+        return data
+
+
+def compact_serialized(tool, serialized, timezone, time_fields=None):
+    """
+    Convert the times in a serialized dataset and make a compact copy of it,
+    one place or submission at a time. Each plain record is let go of as soon
+    as its compact copy is made, so that the plain and the compact copies of
+    the dataset are never both held in full.
+    """
+    compactor = Compactor()
+
+    def compact_records(records, compact_record):
+        records = list(records)
+        compacted = []
+        for index in range(len(records)):
+            record, records[index] = records[index], None
+            compacted.append(compact_record(tool.convert_times(record, timezone, time_fields)))
+        return tuple(compacted)
+
+    places = compact_records(serialized.pop('places', ()), compactor.compact_place)
+    submission_sets = serialized.pop('submission_sets', None)
+
+    data = tool.convert_times(serialized, timezone, time_fields)
+    data['places'] = places
+    if submission_sets is not None:
+        data['submission_sets'] = dict(
+            (set_name, compact_records(submission_sets.pop(set_name), compactor.compact))
+            for set_name in list(submission_sets))
+    return compactor.compact(data)
 
-    # Convert times to local timezone
+
+def get_record_times(serialized):
+    """
+    Get the (created, latest) UTC sort keys of each place and submission in a
+    serialized dataset, in the same order as the records, by set name.
+    """
+    record_times = {'places': [get_record_sort_keys(place) for place in serialized.get('places', ())]}
+    for set_name, submissions in serialized.get('submission_sets', {}).items():
+        record_times[set_name] = [get_record_sort_keys(submission) for submission in submissions]
+    return record_times
+
+
+class ReportData (object):
+    """
+    The serialized dataset that reports are rendered from, with its times
+    converted to a single timezone. It's prepared once per timezone and
+    shared (read-only) by every report that uses that timezone.
+    """
+    def __init__(self, tool, dataset, timezone, time_fields=None, compact_data=False):
+        print('Converting times to %s...' % (timezone,), file=sys.stderr)
+        self.timezone = timezone
+        if time_fields is not None: time_fields = set(time_fields)
+
+        serialized = dataset.serialize()
+        self.record_times = get_record_times(serialized)
+
+        # Large datasets can be kept in the compact form (see compact.py)
+        # instead of as FrozenDicts.
+        if compact_data:
+            self.dataset = compact_serialized(tool, serialized, timezone, time_fields)
+        else:
+            self.dataset = freeze(tool.convert_times(serialized, timezone, time_fields))
+
+        # Index the places by both URL and ID, so that submissions can be
+        # matched to their places without re-serializing them.
+        self.places_by_url = {}
+        self.places_by_id = {}
+        for place in self.dataset.get('places', ()):
+            properties = place.get('properties', {})
+            place_id = place.get('id', properties.get('id'))
+            place_url = properties.get('url', place.get('url'))
+
+            if place_id is not None: self.places_by_id[place_id] = place
+            if place_url is not None: self.places_by_url[place_url] = place
+
+        self._submissions_by_place = None
+        self._digests = {}
+
+    def get_increment(self, watermark=None):
+        """
+        Get a view of this data with only the places and submissions that were
+        created or updated after the watermark, along with the new watermark
+        and the totals of places and submissions in each set. The totals are
+        counted from all of this data, not carried forward from the last run,
+        so they go down when records are deleted.
+        """
+        # The records are compared on their original (UTC) times, since only
+        # the time fields that the templates use are converted.
+        def is_new(times):
+            return watermark is None or times[1] > watermark
+
+        record_sets = [('places', self.dataset.get('places', ()))]
+        record_sets.extend(sorted(self.dataset.get('submission_sets', {}).items()))
+
+        new_totals = {}
+        new_watermark = watermark
+        new_record_sets = {}
+        new_record_times = {}
+        for set_name, records in record_sets:
+            record_times = self.record_times.get(set_name, ())
+            new_pairs = [(record, times) for record, times in zip(records, record_times) if is_new(times)]
+            new_record_sets[set_name] = tuple(record for record, _ in new_pairs)
+            new_record_times[set_name] = [times for _, times in new_pairs]
+
+            new_totals[set_name] = len(records)
+
+            if new_pairs:
+                latest = max(times[1] for _, times in new_pairs)
+                new_watermark = max(new_watermark or '', latest)
+
+        dataset = dict(self.dataset)
+        dataset['places'] = new_record_sets.pop('places')
+        if 'submission_sets' in self.dataset:
+            dataset['submission_sets'] = FrozenDict(new_record_sets)
+
+        # The view shares this data's place index, since new submissions may
+        # be on places that haven't changed.
+        view = copy.copy(self)
+        view.dataset = FrozenDict(dataset)
+        view.record_times = new_record_times
+        view._submissions_by_place = None
+        view._digests = {}
+        return view, new_watermark, new_totals
+
+    def get_digest(self, requirements):
+        """
+        Hash the parts of this data that the given TemplateRequirements use.
+        """
+        if requirements.all_submission_sets:
+            set_names = sorted(self.dataset.get('submission_sets', {}))
+        else:
+            set_names = requirements.get_set_names()
+        set_names = [None] + (['places'] if requirements.places else []) + set_names
+
+        return ':'.join(self._get_set_digest(set_name) for set_name in set_names)
+
+    def _get_set_digest(self, set_name):
+        # The digest of each set is computed once and shared by all of the
+        # reports rendered from this data. A set_name of None means the
+        # dataset's own attributes.
+        if set_name not in self._digests:
+            if set_name is None:
+                records = [dict((key, value) for key, value in self.dataset.items() if key not in ('places', 'submission_sets'))]
+            elif set_name == 'places':
+                records = self.dataset.get('places', ())
+            else:
+                records = self.dataset.get('submission_sets', {}).get(set_name, ())
+
+            digest = hashlib.sha1()
+            for record in records:
+                digest.update(json.dumps(record, sort_keys=True, default=json_default).encode('utf-8'))
+            self._digests[set_name] = digest.hexdigest()
+        return self._digests[set_name]
+
+    def __getstate__(self):
+        # The place/submission join is keyed by the places' identities, which
+        # don't survive pickling, so let it be rebuilt when it's needed.
+        state = self.__dict__.copy()
+        state['_submissions_by_place'] = None
+        return state
+
+    def get_place(self, url):
+        try:
+            return self.places_by_url[url]
+        except KeyError:
+            place_id = int(url.rsplit('/', 1)[-1])
+            return self.places_by_id.get(place_id)
+
+    def get_place_submissions(self, url, set_name=None):
+        """
+        Get the submissions attached to a place, from one submission set, or
+        from all of them if no set is named.
+        """
+        # Join the places to their submissions the first time a template asks
+        # for it.
+        if self._submissions_by_place is None:
+            submissions_by_place = {}
+            for sset_name, submissions in self.dataset.get('submission_sets', {}).items():
+                for submission in submissions:
+                    place = self.get_place(submission['place'])
+                    if place is None: continue
+                    place_sets = submissions_by_place.setdefault(id(place), {})
+                    place_sets.setdefault(sset_name, []).append(submission)
+            for place_sets in submissions_by_place.values():
+                for sset_name in place_sets:
+                    place_sets[sset_name] = tuple(place_sets[sset_name])
+            self._submissions_by_place = submissions_by_place
+
+        place = self.get_place(url) if url else None
+        place_sets = self._submissions_by_place.get(id(place), {})
+        if set_name is None:
+            return [submission for submissions in place_sets.values() for submission in submissions]
+        return place_sets.get(set_name, [])
+
+
+def get_report_timezone(config, report):
+    import pytz
     tzname = config.get('timezone') or report.get('timezone') or None
     try:
-        localtz = pytz.timezone(tzname) if tzname else pytz.utc
+        return pytz.timezone(tzname) if tzname else pytz.utc
     except pytz.exceptions.UnknownTimeZoneError:
         print ('I do not recognize the timezone "%s".' % tzname)
         print ('To see a list of common timezone names, run '
                '"common_timezones.py".')
-        return 1
+        return None
 
-    tool.convert_times(places, localtz)
-    tool.convert_times(submissions, localtz)
-    tool.convert_times(dataset, localtz)
+
+def main(config, reports, processes=1, fetch_all=False, force=False, compact_data=False):
+    if 'username' in config and 'password' in config:
+        auth_info = (config['username'], config['password'])
+    else:
+        auth_info = None
+
+    # Check the timezones before downloading anything
+    report_timezones = []
+    for report in reports:
+        localtz = get_report_timezone(config, report)
+        if localtz is None: return 1
+        report_timezones.append(localtz)
+
+    # Figure out what data the report templates actually use
+    if fetch_all:
+        requirements = TemplateRequirements.everything()
+    else:
+        requirements = TemplateRequirements()
+        for report in reports:
+            assert report.get('summary_template'), 'No template file specified'
+            requirements.update(analyze_template_file(report['summary_template']))
+        print('The reports use %r' % (requirements,), file=sys.stderr)
+
+    # Download the data
+    tool = ShareaboutsTool(config['host'], auth=auth_info)
+    if requirements.places:
+        tool.get_places(config['owner'], config['dataset'])
+    if requirements.submissions:
+        tool.get_submissions(config['owner'], config['dataset'], set_names=requirements.get_set_names())
+    dataset = tool.api.account(config['owner']).dataset(config['dataset'])
+    if not requirements.submissions:
+        dataset.fetch()
+
+    # Convert the data once for each timezone that the reports need
+    data_by_timezone = {}
+    for localtz in report_timezones:
+        if localtz.zone not in data_by_timezone:
+            data_by_timezone[localtz.zone] = ReportData(tool, dataset, localtz, requirements.get_time_fields(), compact_data)
+
+    # The reports are rendered from the converted data, so let go of the API's
+    # models (which hold the dataset as it was downloaded).
+    tool = dataset = None
+    report_jobs = [(config, report, localtz.zone, force) for report, localtz in zip(reports, report_timezones)]
+
+    # Reports that go to their own files can be rendered side by side. Reports
+    # that go to stdout are rendered in order, after those.
+    parallel_jobs = [job for job in report_jobs if 'outfile' in job[1]] if processes > 1 else []
+    serial_jobs = [job for job in report_jobs if job not in parallel_jobs]
+
+    # Emails are sent in the background while the reports are rendered.
+    mailer = None
+    if 'email' in config:
+        mailer = PostmarkSender.from_config(config)
+        mailer.start()
+
+    try:
+        if parallel_jobs:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes, initializer=_init_render_worker, initargs=(data_by_timezone,))
+            try:
+                results = pool.map(_render_in_worker, parallel_jobs)
+            finally:
+                pool.close()
+                pool.join()
+            for status, emails in results:
+                for email, on_sent in emails:
+                    mailer.send(email, on_sent)
+            for status, _ in results:
+                if status != 0: return status
+
+        for config, report, zone, force in serial_jobs:
+            status = generate_single_report(config, report, data_by_timezone[zone], force, mailer)
+            if status != 0: return status
+
+    finally:
+        if mailer is not None:
+            print('Waiting for the emails to be sent...', file=sys.stderr)
+            mailer.close()
+            print('%s email(s) sent, %s failed.' % (mailer.num_sent, mailer.num_failed), file=sys.stderr)
+
+
+worker_data_by_timezone = None
+
+def _init_render_worker(data_by_timezone):
+    global worker_data_by_timezone
+    worker_data_by_timezone = data_by_timezone
+
+def _render_in_worker(job):
+    # Emails are handed back to the main process to be sent from there.
+    config, report, zone, force = job
+    outbox = EmailOutbox()
+    status = generate_single_report(config, report, worker_data_by_timezone[zone], force, outbox)
+    return status, outbox.emails
+
+
+def get_report_fingerprint(config, report, template_source, data, watermark=None, totals=None):
+    """
+    Hash everything that a report's output depends on: the template, the
+    configuration, and the data that the template uses. Incremental reports
+    pass no data; their new watermark and totals stand in for it.
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(template_source.encode('utf-8'))
+    fingerprint.update(json.dumps([config, report, watermark, totals], sort_keys=True, default=str).encode('utf-8'))
+    if data is not None:
+        fingerprint.update(data.get_digest(analyze_template(template_source)).encode('utf-8'))
+
+    # Templates that look at the current date can change from day to day.
+    if re.search(r'\btoday\b|created_within_days', template_source):
+        fingerprint.update(datetime.date.today().isoformat().encode('utf-8'))
+
+    return fingerprint.hexdigest()
+
+
+def get_file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def reuse_last_output(report, output_digest):
+    """
+    Put out a report's output from its last run again. Returns False if there
+    is no output to reuse, or if it isn't the output that was saved with the
+    report's state (e.g. the outfile has since been edited or replaced).
+    """
+    last_output_filename = report['outfile'] if 'outfile' in report else report['state_file'] + '.out'
+    if not output_digest or not os.path.exists(last_output_filename):
+        return False
+    if get_file_digest(last_output_filename) != output_digest:
+        return False
+
+    if 'outfile' in report:
+        return True
+
+    outfile_b = getattr(sys.stdout, 'buffer', sys.stdout)
+    with open(last_output_filename, 'rb') as last_output:
+        shutil.copyfileobj(last_output, outfile_b)
+    outfile_b.flush()
+    return True
+
+
+def generate_single_report(config, report, data, force=False, mailer=None):
+    template_filename = report.get('summary_template')
+    assert template_filename, 'No template file specified'
+
+    with open(report['summary_template'], 'rb') as template_file:
+        template_source = template_file.read().decode()
 
     helpers['config'] = lambda this, attr=None: config if attr is None else config[attr]
     helpers['report'] = lambda this, attr=None: report if attr is None else report[attr]
 
-    # Render the template
+    state = watermark = totals = None
+    if report.get('state_file'):
+        state = ReportState(report['state_file'])
+
+    # Incremental reports only render the places and submissions that were
+    # created or updated since the last run, along with the totals of the
+    # whole dataset. The watermark and totals are kept in the report's state
+    # file.
+    if report.get('incremental'):
+        assert state is not None, 'Incremental reports need a state_file (or run with --state-dir)'
+        # Watermarks from before they were kept in UTC have an offset.
+        watermark = utc_sort_key(state.get('watermark')) or None
+        data, new_watermark, totals = data.get_increment(watermark)
+
+    # If nothing that the report depends on has changed since its last run,
+    # reuse the last output instead of rendering and sending it again. An
+    # incremental report's output is the same as long as its new watermark
+    # and totals are; but one that goes to stdout is always rendered, since
+    # repeating its last increment would report those changes twice.
+    if state is not None:
+        if report.get('incremental'):
+            fingerprint = get_report_fingerprint(config, report, template_source, None, new_watermark, totals)
+            can_reuse = 'outfile' in report
+        else:
+            fingerprint = get_report_fingerprint(config, report, template_source, data)
+            can_reuse = True
+        if (not force and can_reuse and fingerprint == state.get('fingerprint') and
+                reuse_last_output(report, state.get('output_digest'))):
+            print('Nothing has changed for %s; skipping it.' % (report['summary_template'],), file=sys.stderr)
+            return 0
+
+    if report.get('incremental'):
+        print('Rendering records changed since %s' % (watermark or 'the beginning',), file=sys.stderr)
+
+    # Compile the template
+    print ('Compiling and rendering the template(s): %s' % (report['summary_template'],), file=sys.stderr)
+    template = compile_template(template_source)
+
+    # Render the template. Sorted and grouped collections are memoized across
+    # renders of the same (read-only) report data, so start a new memo when
+    # the data changes.
+    global report_data
+    if data is not report_data:
+        clear_render_memo()
+        report_data = data
+
     rendered_template = template({
-        'dataset': dataset.serialize(),
+        'dataset': report_data.dataset,
         'report': report,
         'config': config,
-        'today': datetime.datetime.now().isoformat()
+        'today': datetime.datetime.now().isoformat(),
+        'since': watermark,
+        'totals': totals
     }, helpers=helpers)
 
-    # Print the template, and send it where it needs to go
-    doc = str_type(rendered_template)
-
+    # Print the template, and send it where it needs to go. The rendered
+    # template is a list of string chunks, so write them out one at a time
+    # instead of joining them into one big document first. The output's
+    # digest is saved with the state, to check the output against before it's
+    # reused.
+    output_digest = hashlib.sha1()
     if 'outfile' in report:
         print('Outputting report file: {}'.format(report['outfile']), file=sys.stderr)
-        import codecs
-        with codecs.open(report['outfile'], 'w', 'utf-8') as outfile:
-            outfile.write(doc)
+        with open(report['outfile'], 'wb') as outfile:
+            for chunk in iter_chunks(rendered_template):
+                chunk_b = chunk.encode('utf-8')
+                outfile.write(chunk_b)
+                output_digest.update(chunk_b)
     else:
-        outfile = sys.stdout
-        with os.fdopen(outfile.fileno(), 'wb') as outfile_b:
-            outfile_b.write(doc.encode('utf-8'))
-
+        # Write bytes to stdout's underlying buffer (Python 3) or to stdout
+        # itself (Python 2), leaving it open for any following reports. Keep a
+        # copy next to the report's state, to reuse if nothing changes.
+        outfile_b = getattr(sys.stdout, 'buffer', sys.stdout)
+        last_output = open(report['state_file'] + '.out', 'wb') if state is not None else None
+        for chunk in iter_chunks(rendered_template):
+            chunk_b = chunk.encode('utf-8')
+            outfile_b.write(chunk_b)
+            output_digest.update(chunk_b)
+            if last_output: last_output.write(chunk_b)
+        outfile_b.flush()
+        if last_output: last_output.close()
+
+
+    # The state is saved once the report has gone out. If it's emailed, that
+    # means once the email has been delivered, so that a failed email is sent
+    # again on the next run.
+    state_update = None
+    if state is not None:
+        values = {'fingerprint': fingerprint, 'output_digest': output_digest.hexdigest()}
+        if report.get('incremental'):
+            values.update(watermark=new_watermark, totals=totals)
+        state_update = StateUpdate(state.filename, values)
 
     if 'email' in config:
-        # Send an email
-        # NOTE: Remember, you must register your sender email addresses with
-        #       Postmark: https://postmarkapp.com/signatures
+        # The email body is the only place the whole document is needed as a
+        # single string.
+        doc = str_type(rendered_template)
+
+        # Queue an email to be sent
         email_body = {
              "From" : config['email']['sender'],
              "To" : config['email']['recipient'],
@@ -188,34 +666,42 @@ def generate_single_report(config, report, tool, dataset, places, submissions):
              # "Headers" : [{}]
         }
 
-        email_headers = {
-             'Content-type': 'application/json',
-             'X-Postmark-Server-Token': config['postmarkapp_token']
-        }
-
         if doc.strip() != '':
-            response = requests.post('https://api.postmarkapp.com/email',
-                 data=json.dumps(email_body),
-                headers=email_headers
-            )
-
-            if response.status_code != 200:
-                print('Received a non-success response (%s): %s' % (response.status_code, response.content), file=sys.stderr)
+            if mailer is not None:
+                mailer.send(email_body, on_sent=state_update)
+            else:
+                mailer = PostmarkSender.from_config(config)
+                mailer.start()
+                mailer.send(email_body, on_sent=state_update)
+                mailer.close()
+            state_update = None
+
+    if state_update is not None:
+        state_update()
 
     return 0
 
-if __name__ == '__main__':
-    parser = ArgumentParser(description='Print the number of places in a dataset.')
+def cli(argv=None, prog=None):
+    parser = ArgumentParser(prog=prog, description='Print the number of places in a dataset.')
     parser.add_argument('configuration', help='The dataset configuration file name')
     parser.add_argument('reports', help='The report configuration file name(s)', nargs='+')
     parser.add_argument('--subject', default='', help='The subject of the email to be sent.')
     parser.add_argument('--begin', help='The date from which you want results. Submissions on or after this date will be included.')
     parser.add_argument('--end', help='The date until which you want results. Submissions before this date will be included.')
+    parser.add_argument('--fetch-all', dest='fetch_all', action='store_true', help='Download all of the dataset\'s data, instead of only what the report templates use.')
+    parser.add_argument('--state-dir', dest='state_dir', help='A directory to keep the reports\' state between runs in, for reports without their own state_file.')
+    parser.add_argument('--force', action='store_true', help='Render and send the reports even if nothing has changed since their last run.')
+    parser.add_argument('--compact', dest='compact_data', action='store_true', help='Keep the dataset in a compact form in memory, for very large datasets.')
+    parser.add_argument('--processes', type=int, default=1, help='The number of processes to render reports that have an outfile with.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     config = json.load(open(args.configuration))
     reports = [json.load(open(r)) for r in args.reports]
 
+    for r, report_filename in zip(reports, args.reports):
+        state_filename = get_state_filename(r, report_filename, args.state_dir)
+        if state_filename: r['state_file'] = state_filename
+
     if args.begin:
         for r in reports:
             r['begin_date'] = args.begin
@@ -227,5 +713,8 @@ if __name__ == '__main__':
         config['email']['subject'] = args.subject
 
     # main(config, args.template, args.begin, args.end)
-    result = main(config, reports) or 0
-    sys.exit(result)
+    result = main(config, reports, processes=args.processes, fetch_all=args.fetch_all, force=args.force, compact_data=args.compact_data) or 0
+    return result
+
+if __name__ == '__main__':
+    sys.exit(cli())
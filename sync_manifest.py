@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+A local record of the places that upload.py has put into a dataset: for each
+source ID, the URL and ID of its place, and a fingerprint of the content that
+was last saved. With a manifest, an upload doesn't have to load the whole
+dataset from the server to find out which source IDs already have places; the
+manifest is kept up to date as saves and deletes complete, and is only
+rebuilt from the server when it's missing, belongs to another dataset, or a
+refresh is asked for.
+
+The fingerprints let an upload skip the places whose content hasn't changed
+since they were last saved, so a source that's regenerated in full with only
+a few changes only sends those few.
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+from report_state import ReportState
+import hashlib
+import json
+import threading
+
+
+def place_fingerprint(place):
+    """
+    Get a hash of a place's content, leaving out the fields that tie it to a
+    particular place on the server (its ID and URL).
+    """
+    content = dict(place)
+    content.pop('id', None)
+    properties = dict(content.get('properties') or {})
+    properties.pop('url', None)
+    content['properties'] = properties
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_source_id(place, mapped_id_field='_imported_id'):
+    """
+    Get the source ID from a loaded place (with it in its properties), or from
+    a place from the server or the manifest.
+    """
+    try:
+        return place['properties'][mapped_id_field]
+    except (KeyError, TypeError):
+        return place.get(mapped_id_field)
+
+
+def get_response_data(place_response):
+    try:
+        data = place_response.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+class SyncManifest (object):
+    # Save the manifest after every so many changes, so that an interrupted
+    # upload loses as little as possible.
+    save_every = 500
+
+    def __init__(self, filename, owner, dataset, mapped_id_field='_imported_id'):
+        self.state = ReportState(filename)
+        self.dataset_name = '%s/%s' % (owner, dataset)
+        self.mapped_id_field = mapped_id_field
+        self.lock = threading.Lock()
+        self.num_changes = 0
+
+        if self.state.get('dataset') == self.dataset_name and self.state.get('mapped_id_field') == mapped_id_field:
+            self.entries = self.state.get('places', {})
+            self.is_current = 'places' in self.state.data
+        else:
+            self.entries = {}
+            self.is_current = False
+
+    def rebuild(self, mapped_places):
+        """
+        Replace the manifest's entries with the mapped places from the server
+        (from ShareaboutsTool.get_source_place_map). Their content isn't known,
+        so they have no fingerprints.
+        """
+        with self.lock:
+            self.entries = dict(
+                ('%s' % (source_id,), {'url': place.get('url'), 'id': place.get('id'), 'hash': None})
+                for source_id, place in mapped_places.items())
+            self.is_current = True
+        self.save()
+
+    def get_mapped_places(self):
+        """
+        Get the places in the manifest in the same form as
+        ShareaboutsTool.get_source_place_map, mapped by their source IDs.
+        """
+        return dict(
+            (source_id, {'url': entry['url'], 'id': entry['id'], self.mapped_id_field: source_id})
+            for source_id, entry in self.entries.items())
+
+    def get_changed_places(self, loaded_places):
+        """
+        Get the loaded places that are new, or whose content has changed since
+        they were last saved (according to their fingerprints).
+        """
+        changed_places = []
+        for place in loaded_places:
+            source_id = get_source_id(place, self.mapped_id_field)
+            entry = self.entries.get('%s' % (source_id,))
+            if entry is None or entry.get('hash') != place_fingerprint(place):
+                changed_places.append(place)
+        return changed_places
+
+    def record_response(self, place, place_response):
+        """
+        Update the manifest with the response to a save or delete of a place.
+        This is called from the upload and delete threads.
+        """
+        source_id = get_source_id(place, self.mapped_id_field)
+        if source_id is None:
+            return
+        source_id = '%s' % (source_id,)
+
+        with self.lock:
+            if place_response.status_code in (200, 201):
+                data = get_response_data(place_response)
+                properties = data.get('properties') or {}
+                old_entry = self.entries.get(source_id, {})
+                self.entries[source_id] = {
+                    'url': properties.get('url') or data.get('url') or old_entry.get('url'),
+                    'id': data.get('id') or old_entry.get('id'),
+                    'hash': place_fingerprint(place),
+                }
+            elif place_response.status_code in (204, 404):
+                # Deleted, or already gone from the server
+                self.entries.pop(source_id, None)
+            else:
+                return
+
+            self.num_changes += 1
+            save_now = (self.num_changes % self.save_every == 0)
+
+        if save_now:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            self.state.set('dataset', self.dataset_name)
+            self.state.set('mapped_id_field', self.mapped_id_field)
+            self.state.set('places', dict(self.entries))
+            self.state.save()
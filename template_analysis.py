@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""
+Work out which parts of a dataset a report template actually uses, by looking
+at the paths and helpers referenced in its source. This lets summarize.py skip
+downloading data that a report will never read, and only convert the times in
+fields that a report will show.
+
+The analysis errs on the side of using more data: anything it can't follow
+(partials, a bare reference to the whole dataset, iterating over every
+submission set) counts as using everything.
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+import re
+
+
+# Helpers that look up places on their own, given submissions or URLs
+PLACE_HELPERS = set(['with_place', 'annotate_with_places', 'submissions_for_place', 'aggregate'])
+
+# Helpers that read created_datetime without it being named in the template
+CREATED_HELPERS = set(['created_between', 'created_within_days'])
+
+mustache_pattern = re.compile(r'{{({?)~?\s*([#/^>!&]?)\s*(.*?)\s*~?}?}}', re.DOTALL)
+token_pattern = re.compile(r'"[^"]*"|\'[^\']*\'|[^\s"\']+')
+
+
+def is_set_name_token(token):
+    # A quoted value that isn't a place URL
+    return token[0] in '"\'' and '/' not in token
+
+
+class TemplateRequirements (object):
+    def __init__(self, places=False, submission_sets=(), all_submission_sets=False, time_fields=(), all_time_fields=False):
+        self.places = places
+        self.submission_sets = set(submission_sets)
+        self.all_submission_sets = all_submission_sets
+        self.time_fields = set(time_fields)
+        self.all_time_fields = all_time_fields
+
+    @classmethod
+    def everything(cls):
+        return cls(places=True, all_submission_sets=True, all_time_fields=True)
+
+    @property
+    def submissions(self):
+        return self.all_submission_sets or bool(self.submission_sets)
+
+    def update(self, other):
+        self.places = self.places or other.places
+        self.submission_sets.update(other.submission_sets)
+        self.all_submission_sets = self.all_submission_sets or other.all_submission_sets
+        self.time_fields.update(other.time_fields)
+        self.all_time_fields = self.all_time_fields or other.all_time_fields
+
+    def get_set_names(self):
+        """
+        The names of the submission sets to fetch, or None for all of them.
+        """
+        return None if self.all_submission_sets else sorted(self.submission_sets)
+
+    def get_time_fields(self):
+        """
+        The names of the fields to convert times in, or None for all of them.
+        """
+        return None if self.all_time_fields else sorted(self.time_fields)
+
+    def __repr__(self):
+        return '<TemplateRequirements places=%r submission_sets=%r time_fields=%r>' % (
+            self.places,
+            'all' if self.all_submission_sets else sorted(self.submission_sets),
+            'all' if self.all_time_fields else sorted(self.time_fields))
+
+
+def split_path(path):
+    """
+    Split a handlebars path into its segments, dropping any parent (../) and
+    this references, and the brackets around segment literals.
+    """
+    segments = []
+    for segment in re.split(r'[./]', path):
+        if segment in ('', '..', 'this'):
+            continue
+        segments.append(segment.strip('[]'))
+    return segments
+
+
+def analyze_path(segments, requirements):
+    if not segments:
+        return
+
+    # Referencing the dataset itself (rather than some part of it) could be
+    # used to get at anything.
+    if segments == ['dataset']:
+        requirements.update(TemplateRequirements.everything())
+        return
+
+    for index, segment in enumerate(segments):
+        if segment == 'places':
+            requirements.places = True
+
+        # A place's properties have their own submission_sets, with data that
+        # comes along with the place. Any other submission_sets is the
+        # dataset's.
+        elif segment == 'submission_sets' and segments[index - 1:index] != ['properties']:
+            if index + 1 < len(segments):
+                requirements.submission_sets.add(segments[index + 1])
+            else:
+                requirements.all_submission_sets = True
+
+    requirements.time_fields.add(segments[-1])
+
+
+def analyze_template(source):
+    """
+    Build the TemplateRequirements for the given template source.
+    """
+    requirements = TemplateRequirements()
+
+    for match in mustache_pattern.finditer(source):
+        _, sigil, content = match.groups()
+
+        if sigil == '!' or sigil == '/':
+            continue
+
+        # We can't follow partials, so assume they use everything.
+        if sigil == '>':
+            return TemplateRequirements.everything()
+
+        tokens = token_pattern.findall(content)
+        if not tokens:
+            continue
+
+        # Outputting a whole object (e.g. {{.}} in an each block) may show
+        # any of its fields.
+        if not sigil and tokens in (['.'], ['this']):
+            requirements.all_time_fields = True
+            continue
+
+        helper_name = tokens[0]
+        if helper_name in PLACE_HELPERS:
+            requirements.places = True
+
+        # submissions_for_place without a quoted set name gets all of the sets
+        # (a lone argument may be the place instead).
+        if helper_name == 'submissions_for_place' and not any(is_set_name_token(token) for token in tokens[1:]):
+            requirements.all_submission_sets = True
+        if helper_name in CREATED_HELPERS:
+            requirements.time_fields.add('created_datetime')
+
+        for token in tokens:
+            if token[0] in '"\'':
+                value = token[1:-1]
+
+                # The set name given to submissions_for_place
+                if helper_name == 'submissions_for_place' and is_set_name_token(token):
+                    requirements.submission_sets.add(value)
+
+                # Quoted values are often attribute paths given to helpers
+                # (sort_by, group_by_date, filter_by, ...), sometimes with a
+                # leading "-" for the direction or a trailing ":day" bucket.
+                segments = split_path(value.lstrip('-').split(':')[0])
+                if segments:
+                    requirements.time_fields.add(segments[-1])
+                continue
+
+            if '=' in token:
+                token = token.split('=', 1)[1]
+            if token[0] == '@' or re.match(r'^-?\d+(\.\d+)?$', token):
+                continue
+
+            analyze_path(split_path(token), requirements)
+
+    return requirements
+
+
+def analyze_template_file(template_filename):
+    with open(template_filename, 'rb') as template_file:
+        return analyze_template(template_file.read().decode())
@@ -2,10 +2,16 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function, unicode_literals, division
-from shareabouts_tool import ShareaboutsTool
+from shareabouts_tool import ShareaboutsTool, set_max_connections
+from sync_manifest import SyncManifest
+from record_filters import compile_filter
+from validation import validate_places, write_rejects
+from spatial import apply_spatial_joins
 from argparse import ArgumentParser
 import json
+import os
 import sys
+import threading
 
 spinner_frames = '\|/―'
 step = 0
@@ -26,24 +32,84 @@ def place_done_callback(place, place_response):
         return
     sys.stdout.flush()
 
+class TargetProgress (object):
+    """
+    A place_done_callback for one target of a fan-out upload. Since the
+    targets are uploaded at the same time, it counts the results instead of
+    showing a spinner, and prints errors with the target's name.
+    """
+    labels = {200: 'saved', 201: 'created', 204: 'deleted'}
+
+    def __init__(self, name, manifest=None):
+        self.name = name
+        self.manifest = manifest
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, place, place_response):
+        label = self.labels.get(place_response.status_code, 'failed')
+        with self.lock:
+            self.counts[label] = self.counts.get(label, 0) + 1
+
+        if label == 'failed':
+            print('[%s] Error saving place %s: %s (%s)' % (self.name, place, place_response.status_code, place_response.text))
+
+        if self.manifest is not None:
+            self.manifest.record_response(place, place_response)
+
+    def summary(self):
+        return ', '.join('%s %s' % (self.counts.get(label, 0), label) for label in ('created', 'saved', 'deleted', 'failed'))
+
 def get_gone_places(config, mapped_places, loaded_places):
-    source_id_field = config.get('source_id_field', None)
+    mapped_id_field = config.get('mapped_id_field', '_imported_id')
     loaded_ids = set([
-        place['properties'].get(source_id_field or 'id')
+        '%s' % (place['properties'].get(mapped_id_field),)
         for place in loaded_places])
-    gone_places = [place for (mapped_id, place) in mapped_places.items() if mapped_id not in loaded_ids]
+    gone_places = [place for (mapped_id, place) in mapped_places.items() if '%s' % (mapped_id,) not in loaded_ids]
     return gone_places
 
-def main(config, silent=True, create=True, update=True, delete=False, partial=True):
+def get_manifest_filename(config, config_filename=None):
+    """
+    Get the name of the sync manifest file for an upload: the config's own
+    manifest_file setting, or a file named after the config file (and the
+    target dataset, for a fan-out upload).
+    """
+    if config.get('manifest_file'):
+        return config['manifest_file']
+    if config_filename:
+        base = os.path.splitext(config_filename)[0]
+        if 'targets' in config or config.get('is_target'):
+            base += '.%s.%s' % (config['owner'], config['dataset'])
+        return base + '.manifest.json'
+    return None
+
+def get_tool(config):
     if 'username' in config and 'password' in config:
         auth_info = (config['username'], config['password'])
     else:
         auth_info = None
 
-    tool = ShareaboutsTool(config['host'], auth=auth_info)
-    all_places = tool.get_places(config['owner'], config['dataset'])
-    mapped_places = tool.get_source_place_map(all_places, mapped_id_field=config.get('mapped_id_field', '_imported_id'))
+    return ShareaboutsTool(config['host'], auth=auth_info)
 
+def get_mapped_places(tool, config, manifest=None, refresh_manifest=False):
+    """
+    Find the places that came from the source before, from the manifest if
+    there's a usable one, or else from the server.
+    """
+    mapped_id_field = config.get('mapped_id_field', '_imported_id')
+
+    if manifest is not None and manifest.is_current and not refresh_manifest:
+        mapped_places = manifest.get_mapped_places()
+        print('Using the %s places in the manifest %s (run with --refresh-manifest to check the server instead).' % (len(mapped_places), manifest.state.filename), file=sys.stderr)
+    else:
+        all_places = tool.get_places(config['owner'], config['dataset'], compact=config.get('compact', False))
+        mapped_places = tool.get_source_place_map(all_places, mapped_id_field=mapped_id_field)
+        if manifest is not None:
+            manifest.rebuild(mapped_places)
+
+    return mapped_places
+
+def load_source_places(tool, config, mapped_places):
     if config['source_file'].endswith('geojson'):
         load_func = tool.updated_from_geojson
     elif config['source_file'].endswith('csv'):
@@ -59,46 +125,232 @@ def main(config, silent=True, create=True, update=True, delete=False, partial=Tr
         mapped_id_field=config.get('mapped_id_field', '_imported_id'),
         default_values=config.get('default_values', {}))
 
+    # Fill in the properties that come from the boundaries the places are in
+    return apply_spatial_joins(config.get('spatial_joins', []), loaded_places)
+
+def get_reject_filename(config, config_filename=None):
+    if config.get('reject_file'):
+        return config['reject_file']
+    if config_filename:
+        return os.path.splitext(config_filename)[0] + '.rejects.csv'
+    return 'rejects.csv'
+
+def validate_source_places(config, loaded_places, reject_filename, processes=None):
+    """
+    Check the loaded places against the config's schema, writing any that are
+    invalid to the reject file. Returns the source IDs of the invalid places,
+    which are not to be sent.
+    """
+    mapped_id_field = config.get('mapped_id_field', '_imported_id')
+    valid_places, rejects = validate_places(loaded_places, config.get('schema', {}), mapped_id_field, processes=processes)
+    print('%s of the %s place(s) are valid.' % (len(valid_places), len(loaded_places)), file=sys.stderr)
+
+    if rejects:
+        write_rejects(rejects, reject_filename, mapped_id_field)
+    return frozenset('%s' % (place['properties'].get(mapped_id_field),) for place, _ in rejects)
+
+def upload_places(tool, config, loaded_places, mapped_places, callback, silent=True, create=True, update=True, delete=False, partial=True, manifest=None, send_unchanged=False, invalid_ids=frozenset(), log=print):
     if create or update:
-        print('Saving the places...')
+        # Never send places that are known to be invalid, and only send the
+        # places that have changed since the last upload, if we know what was
+        # sent. (Invalid places still count as present in the source, so
+        # they're not taken to be gone.)
+        mapped_id_field = config.get('mapped_id_field', '_imported_id')
+        places_to_save = [place for place in loaded_places
+                          if '%s' % (place['properties'].get(mapped_id_field),) not in invalid_ids]
+        if manifest is not None and not send_unchanged:
+            num_valid_places = len(places_to_save)
+            places_to_save = manifest.get_changed_places(places_to_save)
+            log('%s of the %s valid places are new or have changed since the last upload.' % (len(places_to_save), num_valid_places))
+
+        log('Saving the places...')
 
         tool.save_places(
             config['owner'], config['dataset'], config['key'],
-            loaded_places, place_done_callback, silent=silent, create=create, update=update, partial=partial)
+            places_to_save, callback, silent=silent, create=create, update=update, partial=partial)
 
     gone_places = get_gone_places(config, mapped_places, loaded_places)
     gone_place_urls = [str(place.get('url')) for place in gone_places]
-    print('\n%s places are no longer present in the imported data:\n  - %s' % (len(gone_places), '\n  - '.join(gone_place_urls)))
+    log('\n%s places are no longer present in the imported data:\n  - %s' % (len(gone_places), '\n  - '.join(gone_place_urls)))
 
     if delete:
-        print('Deleting the places...')
-        global step
-        step = 1
+        log('Deleting the places...')
         tool.delete_places(
             config['owner'], config['dataset'], config['key'],
-            gone_places, place_done_callback)
+            gone_places, callback)
+
+def main(config, silent=True, create=True, update=True, delete=False, partial=True, manifest_filename=None, refresh_manifest=False, send_unchanged=False, validate=True, reject_filename='rejects.csv', processes=None):
+    tool = get_tool(config)
+
+    manifest = None
+    if manifest_filename:
+        manifest = SyncManifest(manifest_filename, config['owner'], config['dataset'], config.get('mapped_id_field', '_imported_id'))
+    mapped_places = get_mapped_places(tool, config, manifest, refresh_manifest)
+
+    def callback(place, place_response):
+        place_done_callback(place, place_response)
+        if manifest is not None:
+            manifest.record_response(place, place_response)
+
+    loaded_places = load_source_places(tool, config, mapped_places)
+
+    invalid_ids = frozenset()
+    if validate:
+        invalid_ids = validate_source_places(config, loaded_places, reject_filename, processes)
+
+    upload_places(tool, config, loaded_places, mapped_places, callback,
+                  silent=silent, create=create, update=update, delete=delete, partial=partial,
+                  manifest=manifest, send_unchanged=send_unchanged, invalid_ids=invalid_ids)
+
+    if manifest is not None:
+        manifest.save()
 
     if not (create or update or delete):
         print ('\nTo modify the data in the dataset, use the create (-c), update (-u), or delete (-d) flags. Run --help for more information.')
 
     print('\nDone!')
 
-if __name__ == '__main__':
-    parser = ArgumentParser(description='Modify the data in a dataset based on an input file specified in the configuration file.')
+def get_target_configs(config):
+    """
+    Get the full config for each of the targets of a fan-out upload: the
+    shared settings, with the target's own settings on top.
+    """
+    target_configs = []
+    for target in config['targets']:
+        target_config = dict((key, value) for key, value in config.items() if key != 'targets')
+        target_config.update(target)
+        target_config['is_target'] = True
+        target_configs.append(target_config)
+    return target_configs
+
+def upload_to_target(target_config, source_places, progress, silent=True, create=True, update=True, delete=False, partial=True, refresh_manifest=False, send_unchanged=False, invalid_ids=frozenset()):
+    name = progress.name
+
+    def log(message):
+        for line in message.strip('\n').split('\n'):
+            print('[%s] %s' % (name, line))
+
+    try:
+        tool = get_tool(target_config)
+        mapped_id_field = target_config.get('mapped_id_field', '_imported_id')
+        mapped_places = get_mapped_places(tool, target_config, progress.manifest, refresh_manifest)
+
+        # Each target gets the source places that match its filters, with the
+        # IDs and URLs of the places already in its dataset.
+        matches_where = compile_filter(target_config.get('where', []))
+        target_places = [place for place in source_places if matches_where(place)]
+        target_places = tool.with_existing_places(target_places, mapped_places, mapped_id_field)
+        log('%s of the %s source places are for this dataset, with %s having been seen before.' % (
+            len(target_places), len(source_places), len([place for place in target_places if 'url' in place['properties']])))
+
+        upload_places(tool, target_config, target_places, mapped_places, progress,
+                      silent=silent, create=create, update=update, delete=delete, partial=partial,
+                      manifest=progress.manifest, send_unchanged=send_unchanged, invalid_ids=invalid_ids, log=log)
+
+    except Exception as e:
+        log('Failed: %s' % (e,))
+        raise
+
+    finally:
+        if progress.manifest is not None:
+            progress.manifest.save()
+
+def main_targets(config, silent=True, create=True, update=True, delete=False, partial=True, config_filename=None, use_manifest=True, refresh_manifest=False, send_unchanged=False, validate=True, reject_filename='rejects.csv', processes=None):
+    """
+    Upload one source file to several datasets (the config's targets) at
+    once. The source is read once, and the targets' uploads share the global
+    limit on connections.
+    """
+    target_configs = get_target_configs(config)
+
+    # Parse the source without any existing places; each target fills in
+    # its own.
+    source_places = load_source_places(get_tool(config), config, {})
+
+    # The source is only checked once, against the shared schema.
+    invalid_ids = frozenset()
+    if validate:
+        invalid_ids = validate_source_places(config, source_places, reject_filename, processes)
+
+    threads = []
+    progresses = []
+    for target_config in target_configs:
+        manifest = None
+        if use_manifest:
+            manifest_filename = get_manifest_filename(target_config, config_filename)
+            if manifest_filename:
+                manifest = SyncManifest(manifest_filename, target_config['owner'], target_config['dataset'], target_config.get('mapped_id_field', '_imported_id'))
+
+        progress = TargetProgress('%s/%s' % (target_config['owner'], target_config['dataset']), manifest)
+        thread = threading.Thread(
+            target=upload_to_target,
+            args=(target_config, source_places, progress),
+            kwargs=dict(silent=silent, create=create, update=update, delete=delete, partial=partial,
+                        refresh_manifest=refresh_manifest, send_unchanged=send_unchanged, invalid_ids=invalid_ids))
+        thread.start()
+        threads.append(thread)
+        progresses.append(progress)
+
+    for thread in threads:
+        thread.join()
+
+    print('\nResults:')
+    for progress in progresses:
+        print('  - %s: %s' % (progress.name, progress.summary()))
+
+    if not (create or update or delete):
+        print ('\nTo modify the data in the datasets, use the create (-c), update (-u), or delete (-d) flags. Run --help for more information.')
+
+    print('\nDone!')
+
+def cli(argv=None, prog=None):
+    parser = ArgumentParser(prog=prog, description='Modify the data in a dataset based on an input file specified in the configuration file.')
     parser.add_argument('configuration', type=str, help='The configuration file name')
     parser.add_argument('-c', '--create', dest='create', action='store_true', help='Create non-existant places')
     parser.add_argument('-u', '--update', dest='update', action='store_true', help='Update pre-existing places')
     parser.add_argument('-r', '--replace', dest='replace', action='store_true', help='Replace existing updated places in full, instead of doing a partial update')
     parser.add_argument('-d', '--delete', dest='delete', action='store_true', help='Delete no longer existing places')
     parser.add_argument('-A', '--do-all', dest='allmod', action='store_true', help='Do all modifiation actions; equivalent to -cud')
+    parser.add_argument('--manifest', dest='manifest_filename', help='The file to keep track of the uploaded places in between runs (defaults to the config\'s manifest_file, or the config file name with .manifest.json). Not allowed with targets, which each have a manifest of their own.')
+    parser.add_argument('--no-manifest', dest='use_manifest', action='store_false', help='Do not use a manifest; always load the dataset\'s places from the server')
+    parser.add_argument('--refresh-manifest', dest='refresh_manifest', action='store_true', help='Rebuild the manifest from the places on the server')
+    parser.add_argument('--all-rows', dest='send_unchanged', action='store_true', help='Save every place in the source, even the ones that have not changed since they were last uploaded')
+    parser.add_argument('--no-validate', dest='validate', action='store_false', help='Send the places without checking them first')
+    parser.add_argument('--reject-file', dest='reject_filename', help='The CSV file to write invalid places to (defaults to the config\'s reject_file, or the config file name with .rejects.csv)')
+    parser.add_argument('--processes', type=int, help='The number of processes to check large sources in (by default they are checked in this process, which is usually quickest)')
+    parser.add_argument('--compact', action='store_true', help='Keep the places loaded from the server in a compact form in memory, for very large datasets')
+    parser.add_argument('--max-connections', type=int, help='The most places to save or delete at a time, across all of the targets (default 4)')
     parser.add_argument('-V', '--activity', dest='silent', action='store_false' ,help='Create dataset activity when creating and updating places')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     config = json.load(open(args.configuration))
 
+    if args.manifest_filename and 'targets' in config:
+        parser.error('--manifest cannot be used with a config that has targets; set manifest_file on each target instead.')
+
     if args.allmod:
         args.create = True
         args.update = True
         args.delete = True
 
-    main(config, create=args.create, update=args.update, delete=args.delete, silent=args.silent, partial=not args.replace)
+    if args.max_connections:
+        set_max_connections(args.max_connections)
+
+    reject_filename = args.reject_filename or get_reject_filename(config, args.configuration)
+    if args.compact: config['compact'] = True
+
+    if 'targets' in config:
+        main_targets(config, create=args.create, update=args.update, delete=args.delete, silent=args.silent, partial=not args.replace,
+                     config_filename=args.configuration, use_manifest=args.use_manifest, refresh_manifest=args.refresh_manifest,
+                     send_unchanged=args.send_unchanged, validate=args.validate, reject_filename=reject_filename, processes=args.processes)
+    else:
+        manifest_filename = None
+        if args.use_manifest:
+            manifest_filename = args.manifest_filename or get_manifest_filename(config, args.configuration)
+
+        main(config, create=args.create, update=args.update, delete=args.delete, silent=args.silent, partial=not args.replace,
+             manifest_filename=manifest_filename, refresh_manifest=args.refresh_manifest, send_unchanged=args.send_unchanged,
+             validate=args.validate, reject_filename=reject_filename, processes=args.processes)
+
+if __name__ == '__main__':
+    sys.exit(cli())